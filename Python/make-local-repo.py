@@ -3,12 +3,20 @@
 __author__ = 'Bradley Frank'
 
 import argparse
+import atexit
+import contextlib
+import hashlib
+import http.client
 import json
 import logging
+import logging.handlers
 import os
-import shutil
+import queue
+import socket
 import subprocess
 import sys
+import threading
+import time
 import urllib.request
 from urllib.error import HTTPError
 from urllib.error import URLError
@@ -18,42 +26,108 @@ PROJECTS = {
 }
 DOWNLOAD_DIR = '/usr/local/cache/yum2'
 GITHUB_URL = 'https://api.github.com/repos/'
+CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+# Seconds a connection may stall before the request is retried
+DOWNLOAD_TIMEOUT = 60
+FEED_CACHE = os.path.join(DOWNLOAD_DIR, '.feeds.json')
+MANIFEST_FILE = os.path.join(DOWNLOAD_DIR, '.manifest.json')
+CREATEREPO_CACHE_DIR = os.path.join(DOWNLOAD_DIR, '.cache')
 
-def get_latest_release(name, owner, repo, repolog):
+def load_feed_cache(repolog):
+    try:
+        with open(FEED_CACHE) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        repolog.log('debug', 'Feed cache not loaded: ' + str(e))
+        return {}
+
+def save_feed_cache(cache, repolog):
+    # Write to a temporary file so an interrupted save keeps the old cache
+    try:
+        with open(FEED_CACHE + '.tmp', 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(FEED_CACHE + '.tmp', FEED_CACHE)
+    except (IOError, OSError) as e:
+        repolog.log('error', 'Could not save feed cache: ' + str(e))
+        return False
+
+    return True
+
+def get_release_assets(name, owner, repo, cache, repolog):
     # Create URL
     release_url = GITHUB_URL + owner + '/' + repo + '/releases/latest'
 
+    # Send the validators from the last run as a conditional request
+    cached = cache.get(name, {})
+    request = urllib.request.Request(release_url)
+    if cached.get('etag'):
+        request.add_header('If-None-Match', cached['etag'])
+    if cached.get('last_modified'):
+        request.add_header('If-Modified-Since', cached['last_modified'])
+
     # Download release feed from GitHub
     try:
-        response = urllib.request.urlopen(release_url)
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        data = response.read().decode('utf-8')
     except HTTPError as e:
-        print(name + ': could not download release information.')
+        if e.code == 304 and 'assets' in cached:
+            repolog.log('info', name + ': release feed not modified.')
+            return cached['assets']
+        repolog.log('error', name +
+                    ': could not download release information.')
         repolog.log('error', e.code)
-        return False
+        return None
     except URLError as e:
-        print(name + ': could not download release information.')
+        repolog.log('error', name +
+                    ': could not download release information.')
         repolog.log('error', e.reason)
-        return False
+        return None
+    except socket.timeout as e:
+        repolog.log('error', name +
+                    ': could not download release information.')
+        repolog.log('error', e)
+        return None
 
-    data = response.readline().decode('utf-8')
     feed = json.loads(data)
 
     # Check that feed actually has releases
     if 'assets' not in feed:
-        print(name + ': could not find release information.')
-        return False
+        repolog.log('error', name + ': could not find release information.')
+        return None
     else:
         repolog.log('info', name + ': downloaded release information.')
 
+    # Keep only what later runs need to find the RPM again
+    assets = [{'name': asset['name'],
+               'browser_download_url': asset['browser_download_url'],
+               'size': asset.get('size'),
+               'digest': asset.get('digest')}
+              for asset in feed['assets']]
+
+    cache[name] = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'assets': assets,
+    }
+
+    return assets
+
+def get_latest_release(name, owner, repo, cache, repolog):
+    with repolog.span('feed', name) as span:
+        assets = get_release_assets(name, owner, repo, cache, repolog)
+        span['ok'] = assets is not None
+    if assets is None:
+        return False
+
     # Search releases for RPM file
-    for asset in feed['assets']:
+    for asset in assets:
         if asset['name'].endswith('.rpm'):
-            download_url = asset['browser_download_url']
             rpm_name = asset['name']
             repolog.log('info', name + ': found latest release RPM.')
             break
     else:
-        print('RPM file not found.')
+        repolog.log('error', 'RPM file not found.')
         return False
 
     # Append new version filename to repo directory
@@ -61,56 +135,199 @@ def get_latest_release(name, owner, repo, repolog):
 
     # Skip if file already exists
     if os.path.isfile(filename):
-        print(name + ': RPM is already at latest release.')
+        repolog.log('info', name + ': RPM is already at latest release.')
         return False
 
     # Download the actual RPM file
-    try:
-        response = urllib.request.urlopen(download_url)
-    except HTTPError as e:
-        print('Could not download release.')
-        repolog.log('error', e.code)
+    with repolog.span('download', name) as span:
+        downloaded = download_release(name, asset, filename, repolog)
+        span['ok'] = downloaded
+        if downloaded:
+            span['bytes'] = os.path.getsize(filename)
+    if not downloaded:
         return False
-    except URLError as e:
-        print('Could not download release.')
-        repolog.log('error', e.reason)
+
+    repolog.log('info', name + ': updated to latest release.')
+    return True
+
+def download_release(name, asset, filename, repolog):
+    part_file = filename + '.part'
+    size = asset.get('size')
+
+    for attempt in range(DOWNLOAD_RETRIES):
+        # Hash whatever an earlier attempt already saved
+        sha256 = hashlib.sha256()
+        offset = 0
+        if os.path.isfile(part_file):
+            with open(part_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    offset += len(chunk)
+
+        # Partial file was finished but never renamed
+        if offset and offset == size:
+            break
+
+        # Only ask for the bytes that are still missing
+        request = urllib.request.Request(asset['browser_download_url'])
+        if offset:
+            request.add_header('Range', 'bytes=' + str(offset) + '-')
+            repolog.log('info', name + ': resuming download at ' +
+                        str(offset) + ' bytes.')
+
+        try:
+            response = urllib.request.urlopen(request,
+                                              timeout=DOWNLOAD_TIMEOUT)
+        except HTTPError as e:
+            if e.code == 416:
+                # Partial file does not belong to this asset
+                os.remove(part_file)
+                continue
+            repolog.log('error', 'Could not download release.')
+            repolog.log('error', e.code)
+            return False
+        except URLError as e:
+            # A stalled connect is retried like a stalled transfer
+            if isinstance(e.reason, socket.timeout):
+                repolog.log('warning', name + ': download timed out.')
+                continue
+            repolog.log('error', 'Could not download release.')
+            repolog.log('error', e.reason)
+            return False
+        except socket.timeout:
+            repolog.log('warning', name + ': download timed out.')
+            continue
+
+        # Server ignored the range so the body starts from zero
+        if offset and response.status != 206:
+            sha256 = hashlib.sha256()
+            offset = 0
+
+        # Save and checksum the RPM in a single pass
+        received = offset
+        try:
+            with open(part_file, 'ab' if offset else 'wb') as f:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    received += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        except (IOError, OSError, http.client.HTTPException) as e:
+            repolog.log('warning', name + ': download interrupted: ' + str(e))
+            continue
+
+        # A connection closed early ends the body without an error, so
+        # resume from what was saved instead of checking a short file
+        length = response.headers.get('Content-Length', '')
+        expected = size or (offset + int(length) if length.isdigit() else None)
+        if expected and received < expected:
+            repolog.log('warning', name + ': download interrupted at ' +
+                        str(received) + ' of ' + str(expected) + ' bytes.')
+            continue
+
+        break
+    else:
+        repolog.log('error', name + ': could not save ' + asset['name'] + '.')
         return False
 
-    # Save the RPM file to disk
-    try:
-        with open(filename, 'wb') as f:
-            shutil.copyfileobj(response, f)
-    except IOError as e:
-        print(name + ': could not save ' + rpm_name + '.')
-        repolog.log('error', e)
+    # Never publish a file that does not match the release asset
+    checksum = sha256.hexdigest()
+    if size and os.path.getsize(part_file) != size:
+        repolog.log('error', name + ': ' + asset['name'] +
+                    ' has the wrong size.')
+        os.remove(part_file)
+        return False
+    if asset.get('digest') and asset['digest'] != 'sha256:' + checksum:
+        repolog.log('error', name + ': ' + asset['name'] + ' failed checksum.')
+        os.remove(part_file)
         return False
 
-    print(name + ': updated to latest release.')
+    os.replace(part_file, filename)
+    repolog.log('debug', name + ': ' + asset['name'] + ' sha256 ' + checksum)
     return True
 
+def build_manifest():
+    # Name, size and mtime of every package createrepo would index
+    manifest = {}
+    for name in os.listdir(DOWNLOAD_DIR):
+        if name.endswith('.rpm'):
+            st = os.stat(os.path.join(DOWNLOAD_DIR, name))
+            manifest[name] = [st.st_size, st.st_mtime_ns]
+
+    return manifest
+
 def createrepo(repolog):
+    # Skip the repository if its packages have not changed
+    manifest = build_manifest()
+    has_metadata = os.path.isfile(os.path.join(DOWNLOAD_DIR, 'repodata',
+                                               'repomd.xml'))
     try:
-        subprocess.call(['createrepo', DOWNLOAD_DIR],
-                        stdout=open(os.devnull, 'wb'),
-                        stderr=open(os.devnull, 'wb'))
+        with open(MANIFEST_FILE) as f:
+            previous = json.load(f)
+    except (IOError, ValueError):
+        previous = None
+
+    if has_metadata and manifest == previous:
+        repolog.log('info', 'Repository unchanged.')
+        return True
+
+    # Only re-read packages that are new or modified
+    createrepo_command = ['createrepo', '--cachedir', CREATEREPO_CACHE_DIR]
+    if has_metadata:
+        createrepo_command.append('--update')
+    createrepo_command.append(DOWNLOAD_DIR)
+
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            returncode = subprocess.call(createrepo_command,
+                                         stdout=devnull,
+                                         stderr=devnull)
     except OSError as e:
-        print('Error creating repository.')
+        repolog.log('error', 'Error creating repository.')
         repolog.log('error', e)
         return False
 
-    print('Successfully created repository.')
+    if returncode != 0:
+        repolog.log('error', 'createrepo exited with status ' +
+                    str(returncode) + '.')
+        return False
+
+    try:
+        with open(MANIFEST_FILE + '.tmp', 'w') as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.replace(MANIFEST_FILE + '.tmp', MANIFEST_FILE)
+    except (IOError, OSError) as e:
+        repolog.log('error', 'Could not save manifest: ' + str(e))
+
+    repolog.log('info', 'Successfully created repository.')
     return True
 
+class jsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        # One JSON object per line, with span fields at the top level
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'span', {}))
+        return json.dumps(entry, sort_keys=True)
+
 class myLogger:
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, json_file=None, prom_file=None):
         # Logging settings
         self.logger = logging.getLogger('reposyncer')
         if not debug:
-            log_level = 0
+            log_level = 20
         else:
             log_level = 10
-        self.logger.setLevel(log_level)
+        self.logger.setLevel(10 if json_file else log_level)
+        self.prom_file = prom_file
+        self.spans = {}
+        self.lock = threading.Lock()
 
         # Logging formats
         _log_format = '[%(asctime)s] [%(levelname)8s] %(message)s'
@@ -120,32 +337,123 @@ class myLogger:
         ch = logging.StreamHandler(sys.stdout)
         ch.setLevel(log_level)
         ch.setFormatter(log_format)
-        self.logger.addHandler(ch)
+        handlers = [ch]
+
+        # Adds a JSON lines handler that also receives every span
+        if json_file:
+            jh = logging.FileHandler(json_file)
+            jh.setLevel(10)
+            jh.setFormatter(jsonFormatter())
+            handlers.append(jh)
+
+        # Workers only enqueue records; a listener thread writes them out
+        log_queue = queue.Queue()
+        self.logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self.listener = logging.handlers.QueueListener(
+            log_queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+        # The listener thread is a daemon, so flush it even when an
+        # uncaught exception ends the run before close()
+        atexit.register(self.close)
 
     def log(self, lvl, msg):
         level = logging.getLevelName(lvl.upper())
         self.logger.log(level, msg)
 
-# Set available arguments
-parser = argparse.ArgumentParser(
-    description='Wrapper for reposync and createrepo.')
-parser.add_argument('-d', '--debug', action='store_true',
-                    help='enables debug messages')
-args = parser.parse_args()
-
-# Configure debugging
-if args.debug:
-    repolog = myLogger(True)
-else:
-    repolog = myLogger(False)
-
-# Create repo directory if it doesn't exist
-if not os.path.isdir(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-
-# Update each RPM
-for name, repo in PROJECTS.items():
-    get_latest_release(name, repo[0], repo[1], repolog)
-
-# Re-create the repository
-createrepo(repolog)
+    @contextlib.contextmanager
+    def span(self, stage, name, **fields):
+        # Time one stage of one project or repository
+        span = dict(fields, stage=stage, name=name)
+        start = time.monotonic()
+        try:
+            yield span
+        except Exception:
+            span['ok'] = False
+            raise
+        finally:
+            span['duration'] = round(time.monotonic() - start, 3)
+            with self.lock:
+                self.spans[(stage, name)] = span
+            self.logger.debug(name + ': ' + stage + ' took ' +
+                              str(span['duration']) + 's.',
+                              extra={'span': span})
+
+    def write_prometheus(self):
+        # Format for the node_exporter textfile collector
+        metrics = [
+            ('duration', 'reposyncer_stage_duration_seconds',
+             'Seconds the last run of each stage took.'),
+            ('bytes', 'reposyncer_stage_bytes',
+             'Bytes transferred by the last run of each stage.'),
+            ('ok', 'reposyncer_stage_success',
+             'Whether the last run of each stage succeeded.'),
+        ]
+        with self.lock:
+            spans = sorted(self.spans.values(),
+                           key=lambda span: (span['stage'], span['name']))
+
+        lines = []
+        for field, metric, description in metrics:
+            lines.append('# HELP ' + metric + ' ' + description)
+            lines.append('# TYPE ' + metric + ' gauge')
+            for span in spans:
+                if span.get(field) is None:
+                    continue
+                labels = 'stage="' + span['stage'] + '",name="' + \
+                    span['name'].replace('\\', '\\\\').replace('"', '\\"') + \
+                    '"'
+                lines.append(metric + '{' + labels + '} ' +
+                             str(float(span[field])))
+        lines.append('# HELP reposyncer_last_run_timestamp_seconds '
+                     'When reposyncer last finished.')
+        lines.append('# TYPE reposyncer_last_run_timestamp_seconds gauge')
+        lines.append('reposyncer_last_run_timestamp_seconds ' +
+                     str(int(time.time())))
+
+        # The collector may read at any time, so never leave a partial file
+        tmp_file = self.prom_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_file, self.prom_file)
+        except (IOError, OSError) as e:
+            self.log('error', 'Could not write metrics: ' + str(e))
+
+    def close(self):
+        atexit.unregister(self.close)
+        if self.prom_file:
+            self.write_prometheus()
+        self.listener.stop()
+
+if __name__ == '__main__':
+    # Set available arguments
+    parser = argparse.ArgumentParser(
+        description='Wrapper for reposync and createrepo.')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='enables debug messages')
+    parser.add_argument('--json-log',
+                        help='also write log records and spans as JSON lines')
+    parser.add_argument('--prom-file',
+                        help='write stage metrics for the textfile collector')
+    args = parser.parse_args()
+
+    # Configure debugging and metrics
+    repolog = myLogger(args.debug, args.json_log, args.prom_file)
+
+    # Create repo directory if it doesn't exist
+    if not os.path.isdir(DOWNLOAD_DIR):
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+    # Update each RPM
+    with repolog.span('phase', 'update'):
+        feed_cache = load_feed_cache(repolog)
+        for name, repo in PROJECTS.items():
+            get_latest_release(name, repo[0], repo[1], feed_cache, repolog)
+        save_feed_cache(feed_cache, repolog)
+
+    # Re-create the repository
+    with repolog.span('createrepo', 'yum2') as span:
+        span['ok'] = createrepo(repolog)
+
+    repolog.close()
@@ -1,29 +1,578 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 __author__ = "Brad Frank"
 __email__ = "bradley.frank@gmail.com"
 __date__ = "12 April 2014"
 __version__ = "0.1"
 
+import collections
 import difflib
+import hashlib
+import itertools
+import json
+import math
+import mmap
 import os
 import re
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
-EXT_REGEX = "(\.[^.]+)$"
+EXT_REGEX = r"(\.[^.]+)$"
 MOVIES = "Movies"
 TV_SHOWS = "TV_Shows"
 VALID_EXTS = ["mkv", "mp4", "avi", "ts", "m4v"]
 
+#
+# Episode numbering: S01E02, 1x02 and air dates for daily shows
+#
+EPISODE_REGEXES = [
+    re.compile(r"[Ss](\d{1,2})[ ._-]?[Ee](\d{1,3})"),
+    re.compile(r"(?<![\dx])(\d{1,2})x(\d{2,3})(?!\d)"),
+    re.compile(r"(?<!\d)((?:19|20)\d\d)[ ._-](\d\d)[ ._-](\d\d)(?!\d)"),
+]
+#
+# Identical files are found by size, then by the first and last block,
+# and only then by hashing everything
+#
+HASH_BLOCK = 64 * 1024
+HASH_CHUNK = 1024 * 1024
+
+MEDIA_CACHE = os.path.expanduser("~/.cache/manageMedia.json")
+#
+# Directories changed this close to a scan may change again within the
+# same mtime, so their listings are never trusted
+#
+RACY_NS = 2 * 1000 * 1000 * 1000
+#
+# Show directories walked at once; network mounts are latency bound
+#
+WALK_WORKERS = 16
+
+#
+# Container headers probed for resolution, codec and duration, cached by
+# file size and mtime
+#
+METADATA_CACHE = os.path.expanduser("~/.cache/manageMedia-metadata.json")
+EBML_HEADER = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_SEEKHEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEKID = 0x53AB
+MKV_SEEKPOSITION = 0x53AC
+MKV_INFO = 0x1549A966
+MKV_TIMECODESCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACKENTRY = 0xAE
+MKV_TRACKTYPE = 0x83
+MKV_CODECID = 0x86
+MKV_VIDEO = 0xE0
+MKV_PIXELWIDTH = 0xB0
+MKV_PIXELHEIGHT = 0xBA
+MKV_CLUSTER = 0x1F43B675
+MKV_PARSED = [MKV_SEEKHEAD, MKV_INFO, MKV_TRACKS]
+MP4_BOXES = [b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide"]
+CODECS = {
+    "V_MPEG4/ISO/AVC": "h264", "AVC1": "h264", "AVC3": "h264",
+    "H264": "h264", "X264": "h264",
+    "V_MPEGH/ISO/HEVC": "hevc", "HVC1": "hevc", "HEV1": "hevc",
+    "V_AV1": "av1", "AV01": "av1",
+    "V_VP9": "vp9", "VP09": "vp9", "V_VP8": "vp8",
+    "V_MPEG4/ISO/ASP": "mpeg4", "MP4V": "mpeg4", "XVID": "mpeg4",
+    "DIVX": "mpeg4", "DX50": "mpeg4", "FMP4": "mpeg4",
+    "V_MPEG2": "mpeg2",
+}
+
+
+def load_cache(cache_file):
+    """
+    """
+
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_cache(cache_file, cache):
+    """
+    """
+
+    #
+    # Write to a temporary file so an interrupted save keeps the old cache
+    #
+    tmp_file = cache_file + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError):
+        pass
+
+
+def scan_directory(directory):
+    """
+    """
+
+    listing = { "dirs": [], "files": [], "links": [] }
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            #
+            # Same rules as os.walk: unreadable entries count as files
+            #
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                listing["dirs"].append(entry.name)
+                if entry.is_symlink():
+                    listing["links"].append(entry.name)
+            else:
+                listing["files"].append(entry.name)
+
+    return listing
+
+
+def list_directory(root, cached):
+    """
+    """
+
+    #
+    # A directory is only listed again when its mtime changed
+    #
+    try:
+        mtime = os.stat(root).st_mtime_ns
+    except OSError:
+        return None
+
+    listing = cached.get(os.path.abspath(root))
+    if listing is None or listing["mtime"] != mtime or \
+            mtime >= listing["scanned"] - RACY_NS:
+        try:
+            listing = scan_directory(root)
+        except OSError:
+            return None
+        listing["mtime"] = mtime
+        listing["scanned"] = time.time_ns()
+
+    return listing
+
+
+def walk_cached(top, cached, scanned):
+    """
+    """
+
+    #
+    # Yields the same (root, dirs, files) as os.walk(top), in the same
+    # order
+    #
+    stack = [top]
+
+    while stack:
+        root = stack.pop()
+        listing = list_directory(root, cached)
+        if listing is None:
+            continue
+
+        scanned[os.path.abspath(root)] = listing
+        yield root, listing["dirs"], listing["files"]
+
+        #
+        # Symlinked directories are listed but not followed
+        #
+        for name in reversed(listing["dirs"]):
+            if name not in listing["links"]:
+                stack.append(os.path.join(root, name))
+
+
+def walk_subtree(root, cached):
+    """
+    """
+
+    scanned = {}
+    return list(walk_cached(root, cached, scanned)), scanned
+
+
+def walk_parallel(top, cached, scanned, workers=WALK_WORKERS):
+    """
+    """
+
+    listing = list_directory(top, cached)
+    if listing is None:
+        return
+
+    scanned[os.path.abspath(top)] = listing
+    yield top, listing["dirs"], listing["files"]
+
+    subdirs = [os.path.join(top, name) for name in listing["dirs"]
+               if name not in listing["links"]]
+
+    #
+    # Each show is walked on its own thread; results come back in listing
+    # order, so the merged walk is the same as a single threaded one
+    #
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for results, subtree in executor.map(
+                lambda root: walk_subtree(root, cached), subdirs):
+            scanned.update(subtree)
+            for result in results:
+                yield result
+
+
+def ebml_vint(data, pos, marker=False):
+    """
+    """
+
+    #
+    # EBML variable length integer; the leading zero bits give its length
+    # and sizes with every value bit set are unknown
+    #
+    first = data[pos]
+    if first == 0:
+        raise ValueError("invalid EBML integer")
+
+    length = 9 - first.bit_length()
+    value = first if marker else first & (0xFF >> length)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+
+    if not marker and value == (1 << (7 * length)) - 1:
+        value = None
+
+    return value, pos + length
+
+
+def ebml_elements(data, start, end):
+    """
+    """
+
+    pos = start
+
+    while pos < end:
+        element, pos = ebml_vint(data, pos, True)
+        size, pos = ebml_vint(data, pos)
+        stop = end if size is None else min(end, pos + size)
+        yield element, pos, stop
+        pos = stop
+
+
+def probe_mkv(data):
+    """
+    """
+
+    info = { "container": "mkv" }
+    scale = 1000000
+    duration = None
+
+    for element, start, end in ebml_elements(data, 0, len(data)):
+        if element == MKV_SEGMENT:
+            segment, segment_end = start, end
+            break
+    else:
+        return info
+
+    #
+    # Top level elements up to the first cluster, then whatever the seek
+    # head says is still missing; anything else, such as Void padding, is
+    # skipped by its size and media data itself is never read
+    #
+    seeks, seen, visited = {}, [], []
+    positions = [segment]
+
+    while positions:
+        visited += positions
+        for element, start, end in ebml_elements(data, positions.pop(),
+                                                 segment_end):
+            if element == MKV_CLUSTER:
+                break
+            if element not in MKV_PARSED or element in seen:
+                continue
+            seen.append(element)
+
+            for child, c_start, c_end in ebml_elements(data, start, end):
+                if element == MKV_SEEKHEAD and child == MKV_SEEK:
+                    seek = dict((e, data[s:t]) for e, s, t in
+                                ebml_elements(data, c_start, c_end))
+                    seeks[int.from_bytes(seek.get(MKV_SEEKID, b""),
+                                         "big")] = segment + \
+                        int.from_bytes(seek.get(MKV_SEEKPOSITION, b""), "big")
+                elif element == MKV_INFO and child == MKV_TIMECODESCALE:
+                    scale = int.from_bytes(data[c_start:c_end], "big")
+                elif element == MKV_INFO and child == MKV_DURATION:
+                    duration = struct.unpack(
+                        ">f" if c_end - c_start == 4 else ">d",
+                        data[c_start:c_end])[0]
+                elif element == MKV_TRACKS and child == MKV_TRACKENTRY:
+                    probe_mkv_track(data, c_start, c_end, info)
+
+        positions = [seeks[element] for element in (MKV_INFO, MKV_TRACKS)
+                     if element in seeks and element not in seen
+                     and seeks[element] not in visited][:1]
+
+    if duration is not None:
+        info["duration"] = duration * scale / 1e9
+
+    return info
+
+
+def probe_mkv_track(data, start, end, info):
+    """
+    """
+
+    track = dict((e, (s, t)) for e, s, t in ebml_elements(data, start, end))
+
+    if "codec" in info or MKV_TRACKTYPE not in track or \
+            int.from_bytes(data[slice(*track[MKV_TRACKTYPE])], "big") != 1:
+        return
+
+    if MKV_CODECID in track:
+        info["codec"] = data[slice(*track[MKV_CODECID])].decode(
+            "ascii", "replace").rstrip("\0")
+
+    if MKV_VIDEO in track:
+        video = dict((e, data[s:t]) for e, s, t in
+                     ebml_elements(data, *track[MKV_VIDEO]))
+        if MKV_PIXELWIDTH in video and MKV_PIXELHEIGHT in video:
+            info["width"] = int.from_bytes(video[MKV_PIXELWIDTH], "big")
+            info["height"] = int.from_bytes(video[MKV_PIXELHEIGHT], "big")
+
+
+def mp4_boxes(data, start, end):
+    """
+    """
+
+    pos = start
+
+    while pos + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError("invalid MP4 box")
+        yield kind, pos + header, min(end, pos + size)
+        pos += size
+
+
+def mp4_box(data, start, end, path):
+    """
+    """
+
+    for kind in path:
+        for child, c_start, c_end in mp4_boxes(data, start, end):
+            if child == kind:
+                start, end = c_start, c_end
+                break
+        else:
+            return None
+
+    return start, end
+
+
+def probe_mp4(data):
+    """
+    """
+
+    info = { "container": "mp4" }
+
+    #
+    # Top level boxes are skipped by size, so a moov after the media data
+    # costs no more than one at the front
+    #
+    moov = mp4_box(data, 0, len(data), [b"moov"])
+    if moov is None:
+        return info
+
+    mvhd = mp4_box(data, moov[0], moov[1], [b"mvhd"])
+    if mvhd is not None:
+        start = mvhd[0]
+        if data[start] == 1:
+            scale, duration = struct.unpack(">IQ", data[start + 20:start + 32])
+        else:
+            scale, duration = struct.unpack(">II", data[start + 12:start + 20])
+        if scale:
+            info["duration"] = duration / scale
+
+    for kind, start, end in mp4_boxes(data, moov[0], moov[1]):
+        hdlr = mp4_box(data, start, end, [b"mdia", b"hdlr"]) \
+            if kind == b"trak" else None
+        if hdlr is None or data[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
+            continue
+
+        #
+        # First sample description: fourcc, then width and height after
+        # the 24 reserved bytes of a visual sample entry
+        #
+        stsd = mp4_box(data, start, end,
+                       [b"mdia", b"minf", b"stbl", b"stsd"])
+        if stsd is not None:
+            entry = stsd[0] + 8
+            info["codec"] = data[entry + 4:entry + 8].decode(
+                "ascii", "replace")
+            info["width"], info["height"] = struct.unpack(
+                ">HH", data[entry + 32:entry + 36])
+        break
+
+    return info
+
+
+def riff_chunks(data, start, end):
+    """
+    """
+
+    pos = start
+
+    while pos + 8 <= end:
+        kind, size = struct.unpack("<4sI", data[pos:pos + 8])
+        if kind == b"LIST":
+            yield data[pos + 8:pos + 12], pos + 12, min(end, pos + 8 + size)
+        else:
+            yield kind, pos + 8, min(end, pos + 8 + size)
+        pos += 8 + size + (size & 1)
+
+
+def probe_avi(data):
+    """
+    """
 
-def index_media(directory):
+    info = { "container": "avi" }
+
+    for kind, start, end in riff_chunks(data, 12, len(data)):
+        if kind != b"hdrl":
+            continue
+
+        for child, c_start, c_end in riff_chunks(data, start, end):
+            if child == b"avih":
+                usec, frames = struct.unpack("<I12xI",
+                                             data[c_start:c_start + 20])
+                info["duration"] = usec * frames / 1e6
+                info["width"], info["height"] = struct.unpack(
+                    "<II", data[c_start + 32:c_start + 40])
+            elif child == b"strl" and "codec" not in info:
+                stream = dict((k, s) for k, s, t in
+                              riff_chunks(data, c_start, c_end))
+                if b"strh" in stream and \
+                        data[stream[b"strh"]:stream[b"strh"] + 4] == b"vids":
+                    codec = data[stream[b"strh"] + 4:stream[b"strh"] + 8]
+                    if b"strf" in stream:
+                        codec = data[stream[b"strf"] + 16:
+                                     stream[b"strf"] + 20]
+                    info["codec"] = codec.decode("ascii", "replace")
+        break
+
+    return info
+
+
+def probe_media(path):
     """
     """
 
-    index = { "shows": [], "invalid": [], "episodes": [] }
+    #
+    # Only container headers are touched through the mapping, so probing a
+    # file reads a few pages rather than the whole file
+    #
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 12:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if struct.unpack(">I", data[0:4])[0] == EBML_HEADER:
+                    info = probe_mkv(data)
+                elif data[4:8] in MP4_BOXES:
+                    info = probe_mp4(data)
+                elif data[0:4] == b"RIFF" and data[8:12] == b"AVI ":
+                    info = probe_avi(data)
+                else:
+                    return None
+    except (IOError, OSError, ValueError, IndexError, struct.error):
+        return None
+
+    if "codec" in info:
+        info["codec"] = CODECS.get(info["codec"].upper(), info["codec"])
+    if info.get("duration"):
+        info["bitrate"] = int(size * 8 / info["duration"])
+
+    return info
+
+
+def probe_metadata(directory, files, cache_file=METADATA_CACHE,
+                   workers=WALK_WORKERS):
+    """
+    """
+
+    metadata = {}
+    cache = load_cache(cache_file) if cache_file else {}
+    probed = {}
+    missing = []
+
+    #
+    # A cached probe is reused while the file keeps its size and mtime
+    #
+    for path in video_files(files):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+
+        key = os.path.abspath(path)
+        entry = cache.get(key)
+        if entry is not None and entry["size"] == stat.st_size and \
+                entry["mtime"] == stat.st_mtime_ns:
+            probed[key] = entry
+            metadata[path] = entry["info"]
+        else:
+            missing.append((path, key, stat))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for (path, key, stat), info in zip(missing, executor.map(
+                lambda item: probe_media(item[0]), missing)):
+            probed[key] = { "size": stat.st_size,
+                            "mtime": stat.st_mtime_ns, "info": info }
+            metadata[path] = info
+
+    #
+    # Files that are gone drop out of this library's entries; other
+    # libraries keep theirs
+    #
+    if cache_file:
+        top = os.path.join(os.path.abspath(directory), "")
+        updated = {key: entry for key, entry in cache.items()
+                   if not key.startswith(top)}
+        updated.update(probed)
+        if updated != cache:
+            save_cache(cache_file, updated)
+
+    return metadata
+
+
+def index_media(directory, cache_file=MEDIA_CACHE, workers=WALK_WORKERS,
+                metadata_file=None):
+    """
+    """
+
+    index = { "shows": [], "invalid": [], "episodes": [], "files": [] }
     current_dir = ""
 
-    for root, dirs, files in os.walk(directory):
+    #
+    # Listings are cached per library, keyed by directory path
+    #
+    cache = load_cache(cache_file) if cache_file else {}
+    top = os.path.abspath(directory)
+    scanned = {}
+
+    for root, dirs, files in walk_parallel(directory, cache.get(top, {}),
+                                           scanned, workers):
         #
         # path (list): current parent directories
         #
@@ -49,6 +598,25 @@ def index_media(directory):
         #
         index["episodes"] += files
 
+        #
+        # Same files with their paths, for checks that need to open them
+        #
+        index["files"] += [os.path.join(root, name) for name in files]
+
+    #
+    # Directories that were not seen this time drop out of the cache
+    #
+    if cache_file:
+        cache[top] = scanned
+        save_cache(cache_file, cache)
+
+    #
+    # Container metadata for the video files, when asked for
+    #
+    if metadata_file:
+        index["metadata"] = probe_metadata(directory, index["files"],
+                                           metadata_file, workers)
+
     #
     # Alphabetize show list
     #
@@ -70,11 +638,106 @@ def invalid_dirs(invalid_dirs):
     # Remove any duplicates from the list
     #
     for directory in set(invalid_dirs):
-        print directory
+        print (directory)
 
     print ("")
 
 
+def bigrams(title):
+    """
+    """
+
+    #
+    # The n-th repeat of a bigram is its own token, so set intersections
+    # count shared bigrams the way multiset intersections would
+    #
+    seen = collections.Counter()
+    tokens = []
+    for i in range(len(title) - 1):
+        gram = title[i:i + 2]
+        tokens.append((gram, seen[gram]))
+        seen[gram] += 1
+
+    return tokens
+
+
+def close_match_candidates(shows, cutoff=0.8):
+    """
+    """
+
+    #
+    # SequenceMatcher.ratio() is 2M/T, where M characters match in k
+    # blocks and T is the combined length. M is at most the shorter
+    # title, and each block of m characters shares m - 1 bigrams. Blocks
+    # are separated by at least one unmatched character, so
+    # k - 1 <= T - 2M and the titles share at least 3M - T - 1 bigrams.
+    # Pairs that fail either bound can never reach the cutoff.
+    #
+    epsilon = 1e-9
+    share = 1.5 * cutoff - 1
+    tokens = [bigrams(show) for show in shows]
+    token_sets = [set(title) for title in tokens]
+    frequency = collections.Counter(token for title in tokens
+                                    for token in title)
+
+    candidates = [[i] for i in range(len(shows))]
+    postings = collections.defaultdict(list)
+    skipped = collections.Counter()
+    loose = []
+
+    #
+    # Shortest titles first, so titles too short to match anything that
+    # is left can be dropped from the front of each posting list
+    #
+    for i in sorted(range(len(shows)), key=lambda i: len(shows[i])):
+        la = len(shows[i])
+        shortest = cutoff * la / (2 - cutoff) - epsilon
+        required = max(0, math.ceil(share * (la + shortest) - 1 - epsilon))
+
+        #
+        # Titles that share enough bigrams must share one of the rarest
+        # bigrams of each title, so only those prefixes are indexed
+        #
+        ordered = sorted(tokens[i], key=lambda token: (frequency[token],
+                                                       token))
+        prefix = ordered[:len(ordered) - required + 1]
+
+        found = set(loose)
+        for token in prefix:
+            entries = postings[token]
+            first = skipped[token]
+            while first < len(entries) and len(shows[entries[first]]) < \
+                    shortest:
+                first += 1
+            skipped[token] = first
+            found.update(itertools.islice(entries, first, None))
+
+        #
+        # Very short titles can match without sharing any bigram
+        #
+        if required == 0:
+            found.update(j for j in range(len(shows))
+                         if len(shows[j]) <= la and j != i)
+            loose.append(i)
+
+        for j in found:
+            lb = len(shows[j])
+            total = la + lb
+            if 2.0 * min(la, lb) < cutoff * total - epsilon:
+                continue
+            if len(token_sets[i] & token_sets[j]) < \
+                    share * total - 1 - epsilon:
+                continue
+            candidates[i].append(j)
+            candidates[j].append(i)
+
+        for token in prefix:
+            postings[token].append(i)
+
+    return {shows[i]: [shows[j] for j in sorted(set(candidates[i]))]
+            for i in range(len(shows))}
+
+
 def duplicate_shows(shows):
     """
     """
@@ -84,17 +747,154 @@ def duplicate_shows(shows):
     print ("Potential duplicate shows")
     print ("--------------------------------------------------------")
 
+    #
+    # Only shortlisted titles are scored, and the shortlist holds every
+    # title that can reach the cutoff, so the matches are unchanged
+    #
+    candidates = close_match_candidates(shows, cutoff=0.8)
+
     for show in shows:
-        fuzzy_matches = difflib.get_close_matches(show, shows, cutoff=0.8)
+        fuzzy_matches = difflib.get_close_matches(show, candidates[show],
+                                                  cutoff=0.8)
         matches = [x for x in fuzzy_matches if x != show]
 
         if len(matches) > 0:
-            print show + ": " + ", ".join(matches)
+            print (show + ": " + ", ".join(matches))
 
     print ("")
 
 
-def duplicate_episodes(episodes):
+def video_files(files):
+    """
+    """
+
+    extSearch = re.compile(EXT_REGEX)
+
+    for path in files:
+        matches = extSearch.findall(path)
+        if matches and matches[0][1:].lower() in VALID_EXTS:
+            yield path
+
+
+def episode_key(path):
+    """
+    """
+
+    #
+    # (show, season, episode) from the show folder and the file name; a
+    # date becomes (show, year, month * 100 + day)
+    #
+    parts = path.split("/")
+    if len(parts) < 3:
+        return None
+
+    for regex in EPISODE_REGEXES:
+        match = regex.search(parts[-1])
+        if match:
+            numbers = [int(group) for group in match.groups()]
+            if len(numbers) == 3:
+                return (parts[1], numbers[0], numbers[1] * 100 + numbers[2])
+            return (parts[1], numbers[0], numbers[1])
+
+    return None
+
+
+def episode_buckets(files):
+    """
+    """
+
+    buckets = collections.defaultdict(list)
+
+    for path in video_files(files):
+        key = episode_key(path)
+        if key is not None:
+            buckets[key].append(path)
+
+    return {key: paths for key, paths in buckets.items() if len(paths) > 1}
+
+
+def hash_file(path, partial=False):
+    """
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        if partial:
+            digest.update(f.read(HASH_BLOCK))
+            size = os.fstat(f.fileno()).st_size
+            if size > 2 * HASH_BLOCK:
+                f.seek(size - HASH_BLOCK)
+            digest.update(f.read(HASH_BLOCK))
+        else:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def group_by(paths, key):
+    """
+    """
+
+    groups = collections.defaultdict(list)
+
+    for path in paths:
+        try:
+            groups[key(path)].append(path)
+        except OSError:
+            continue
+
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def identical_files(files):
+    """
+    """
+
+    #
+    # Each stage only looks at files that still collide; files no larger
+    # than the two blocks were hashed whole by the partial stage
+    #
+    duplicates = []
+
+    for same_size in group_by(video_files(files), os.path.getsize):
+        #
+        # Empty files are all alike without being copies of anything
+        #
+        if os.path.getsize(same_size[0]) == 0:
+            continue
+        for same_ends in group_by(same_size,
+                                  lambda path: hash_file(path, True)):
+            if os.path.getsize(same_ends[0]) <= 2 * HASH_BLOCK:
+                duplicates.append(same_ends)
+                continue
+            duplicates += group_by(same_ends, hash_file)
+
+    return sorted(duplicates)
+
+
+def describe_media(info):
+    """
+    """
+
+    if not info:
+        return "unknown"
+
+    details = []
+    if info.get("width") and info.get("height"):
+        details.append("%dx%d" % (info["width"], info["height"]))
+    if info.get("codec"):
+        details.append(info["codec"])
+    if info.get("duration"):
+        details.append("%dm" % round(info["duration"] / 60))
+    if info.get("bitrate"):
+        details.append("%.1f Mb/s" % (info["bitrate"] / 1e6))
+
+    return " ".join(details) or info["container"]
+
+
+def duplicate_episodes(files, metadata=None):
     """
     """
 
@@ -103,15 +903,29 @@ def duplicate_episodes(episodes):
     print ("Duplicate episodes")
     print ("--------------------------------------------------------")
 
-    extSearch = re.compile(EXT_REGEX)
+    for key, paths in sorted(episode_buckets(files).items()):
+        show, season, episode = key
+        if season >= 1900:
+            label = "%d-%02d-%02d" % (season, episode // 100, episode % 100)
+        else:
+            label = "S%02dE%02d" % (season, episode)
+        if metadata is not None:
+            paths = [path + " (" + describe_media(metadata.get(path)) + ")"
+                     for path in paths]
+        print (show + " " + label + ": " + ", ".join(paths))
+
+    print ("")
+    print ("========================================================")
+    print ("Identical files")
+    print ("--------------------------------------------------------")
 
-    for episode in episodes:
-        matches = extSearch.findall(episode)
-        print (matches[0])
+    for paths in identical_files(files):
+        print (", ".join(paths))
 
 
 
-index = index_media(MOVIES)
-invalid_dirs(index["invalid"])
-duplicate_shows(index["shows"])
-#duplicate_episodes(index["episodes"])
\ No newline at end of file
+if __name__ == "__main__":
+    index = index_media(MOVIES, metadata_file=METADATA_CACHE)
+    invalid_dirs(index["invalid"])
+    duplicate_shows(index["shows"])
+    duplicate_episodes(index["files"], index["metadata"])
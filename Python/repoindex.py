@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+__author__ = 'Bradley Frank'
+
+import argparse
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+INDEX_DB = '/var/cache/reposyncer/index.sqlite'
+REPO_ROOT_DIR = '/srv/repos'
+REPOMD_NS = '{http://linux.duke.edu/metadata/repo}'
+COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+BATCH_SIZE = 1000
+AUDIT_READ_SIZE = 8 * 1024 * 1024
+AUDIT_CHUNKS = 8
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    repo TEXT NOT NULL,
+    label TEXT NOT NULL,
+    checksum TEXT,
+    indexed REAL NOT NULL,
+    UNIQUE (repo, label)
+);
+CREATE TABLE IF NOT EXISTS packages (
+    snapshot INTEGER NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    epoch TEXT NOT NULL,
+    version TEXT NOT NULL,
+    release TEXT NOT NULL,
+    arch TEXT NOT NULL,
+    checksum TEXT,
+    size INTEGER,
+    location TEXT
+);
+CREATE INDEX IF NOT EXISTS packages_checksum
+    ON packages (snapshot, checksum);
+CREATE TABLE IF NOT EXISTS audit_cache (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (device, inode, algorithm)
+);
+'''
+
+
+def find_primary(repo_dir):
+    # repomd.xml names the primary file, which carries a checksum prefix
+    repomd = os.path.join(repo_dir, 'repodata', 'repomd.xml')
+    for data in ET.parse(repomd).getroot().iter(REPOMD_NS + 'data'):
+        if data.get('type') == 'primary':
+            location = data.find(REPOMD_NS + 'location').get('href')
+            checksum = data.find(REPOMD_NS + 'checksum')
+            return (os.path.join(repo_dir, location),
+                    checksum.text if checksum is not None else None)
+
+    raise ValueError(repomd + ' does not list primary metadata')
+
+
+def parse_primary(primary_file):
+    # Yield one package at a time and drop it from the tree afterwards
+    opener = gzip.open if primary_file.endswith('.gz') else open
+    with opener(primary_file, 'rb') as f:
+        root = None
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end' or elem.tag != COMMON_NS + 'package':
+                continue
+            if elem.get('type') == 'rpm':
+                version = elem.find(COMMON_NS + 'version')
+                checksum = elem.find(COMMON_NS + 'checksum')
+                size = elem.find(COMMON_NS + 'size')
+                location = elem.find(COMMON_NS + 'location')
+                yield {
+                    'name': elem.findtext(COMMON_NS + 'name'),
+                    'epoch': version.get('epoch', '0'),
+                    'version': version.get('ver'),
+                    'release': version.get('rel'),
+                    'arch': elem.findtext(COMMON_NS + 'arch'),
+                    'checksum': checksum.text if checksum is not None
+                    else None,
+                    'checksum_type': checksum.get('type') if checksum
+                    is not None else None,
+                    'size': int(size.get('package')) if size is not None
+                    else None,
+                    'location': location.get('href') if location is not None
+                    else None,
+                }
+            root.clear()
+
+
+def hash_package(path, algorithm):
+    # Runs in a worker process; one large buffer is reused for every read
+    buf = bytearray(AUDIT_READ_SIZE)
+    view = memoryview(buf)
+    try:
+        digest = hashlib.new('sha1' if algorithm == 'sha' else algorithm)
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                size = f.readinto(buf)
+                if not size:
+                    break
+                digest.update(view[:size])
+    except (OSError, ValueError):
+        return None
+
+    return digest.hexdigest()
+
+
+def find_repositories(root):
+    # Every directory with repodata, plus every package file under root;
+    # absolute so the paths match the normalized repodata locations
+    root = os.path.abspath(root)
+    repos = []
+    rpms = set()
+    for dirpath, dirs, files in os.walk(root):
+        repomd = os.path.join(dirpath, 'repodata', 'repomd.xml')
+        if 'repodata' in dirs and os.path.isfile(repomd):
+            repos.append(dirpath)
+        dirs[:] = sorted(name for name in dirs
+                         if name != 'repodata' and not name.startswith('.'))
+        rpms.update(os.path.join(dirpath, name) for name in files
+                    if name.endswith('.rpm'))
+
+    return repos, rpms
+
+
+def evr(package):
+    if package['epoch'] and package['epoch'] != '0':
+        return package['epoch'] + ':' + package['version'] + '-' + \
+            package['release']
+    return package['version'] + '-' + package['release']
+
+
+class repodataindex:
+
+    def __init__(self, db_file=INDEX_DB):
+        if db_file != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_file)),
+                        exist_ok=True)
+        self.db = sqlite3.connect(db_file)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+
+    def snapshot_id(self, repo, label):
+        row = self.db.execute(
+            'SELECT id FROM snapshots WHERE repo = ? AND label = ?',
+            (repo, label)).fetchone()
+        if row is None:
+            raise KeyError(repo + ' has no snapshot ' + label)
+        return row['id']
+
+    def index(self, repo, label, repo_dir):
+        # Returns the package count, or None when the metadata is unchanged
+        primary_file, checksum = find_primary(repo_dir)
+        row = self.db.execute(
+            'SELECT id, checksum FROM snapshots WHERE repo = ? AND label = ?',
+            (repo, label)).fetchone()
+        if row is not None and checksum and row['checksum'] == checksum:
+            return None
+
+        with self.db:
+            if row is not None:
+                self.db.execute('DELETE FROM snapshots WHERE id = ?',
+                                (row['id'],))
+            snapshot = self.db.execute(
+                'INSERT INTO snapshots (repo, label, checksum, indexed) '
+                'VALUES (?, ?, ?, ?)',
+                (repo, label, checksum, time.time())).lastrowid
+
+            # Insert in batches so memory stays flat for any repository
+            count = 0
+            batch = []
+            for package in parse_primary(primary_file):
+                batch.append((snapshot, package['name'], package['epoch'],
+                              package['version'], package['release'],
+                              package['arch'], package['checksum'],
+                              package['size'], package['location']))
+                if len(batch) >= BATCH_SIZE:
+                    count += self.insert(batch)
+                    batch = []
+            count += self.insert(batch)
+
+        return count
+
+    def insert(self, batch):
+        self.db.executemany(
+            'INSERT INTO packages (snapshot, name, epoch, version, release, '
+            'arch, checksum, size, location) VALUES (?, ?, ?, ?, ?, ?, ?, ?, '
+            '?)', batch)
+        return len(batch)
+
+    def latest(self, repo):
+        row = self.db.execute(
+            'SELECT label, checksum FROM snapshots WHERE repo = ? ORDER BY '
+            'indexed DESC LIMIT 1', (repo,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def snapshots(self, repo=None):
+        query = 'SELECT s.repo, s.label, s.indexed, COUNT(p.name) AS ' \
+            'packages, SUM(p.size) AS size FROM snapshots s LEFT JOIN ' \
+            'packages p ON p.snapshot = s.id'
+        params = ()
+        if repo is not None:
+            query += ' WHERE s.repo = ?'
+            params = (repo,)
+        query += ' GROUP BY s.id ORDER BY s.repo, s.indexed'
+        return [dict(row) for row in self.db.execute(query, params)]
+
+    def only_in(self, first, second):
+        # Builds in the first snapshot that the second does not have; the
+        # package checksum identifies a build, so one index lookup each
+        return [dict(row) for row in self.db.execute(
+            'SELECT p.* FROM packages p WHERE p.snapshot = ? AND NOT EXISTS '
+            '(SELECT 1 FROM packages o WHERE o.snapshot = ? AND '
+            'o.checksum = p.checksum) ORDER BY p.name, p.arch',
+            (first, second))]
+
+    def diff(self, repo, old_label, new_label):
+        old = self.snapshot_id(repo, old_label)
+        new = self.snapshot_id(repo, new_label)
+        added = self.only_in(new, old)
+        removed = self.only_in(old, new)
+
+        # A name.arch that lost one build and gained another was updated
+        gone = {}
+        for package in removed:
+            gone.setdefault((package['name'], package['arch']),
+                            []).append(package)
+        updated = []
+        for package in added:
+            key = (package['name'], package['arch'])
+            if key in gone:
+                updated.append({'name': package['name'],
+                                'arch': package['arch'],
+                                'old': [evr(p) for p in gone[key]],
+                                'new': evr(package),
+                                'size': package['size'],
+                                'location': package['location']})
+        updated_keys = set((p['name'], p['arch']) for p in updated)
+
+        return {
+            'added': [p for p in added
+                      if (p['name'], p['arch']) not in updated_keys],
+            'removed': [p for p in removed
+                        if (p['name'], p['arch']) not in updated_keys],
+            'updated': updated,
+        }
+
+    def plan(self, repo, local_label, upstream_label):
+        # What a sync from upstream would download and delete locally
+        local = self.snapshot_id(repo, local_label)
+        upstream = self.snapshot_id(repo, upstream_label)
+        download = self.only_in(upstream, local)
+        delete = self.only_in(local, upstream)
+
+        return {
+            'download': download,
+            'delete': delete,
+            'bytes': sum(p['size'] or 0 for p in download),
+        }
+
+    def prune(self, repo, keep):
+        # Drop all but the newest snapshots of a repository
+        with self.db:
+            cursor = self.db.execute(
+                'DELETE FROM snapshots WHERE repo = ? AND id NOT IN (SELECT '
+                'id FROM snapshots WHERE repo = ? ORDER BY indexed DESC '
+                'LIMIT ?)', (repo, repo, keep))
+        return cursor.rowcount
+
+    def audit(self, root, workers=None):
+        # Compare every package under root with the repodata listing it
+        repos, rpms = find_repositories(root)
+        expected = {}
+        for repo_dir in repos:
+            primary_file = find_primary(repo_dir)[0]
+            for package in parse_primary(primary_file):
+                if not package['location']:
+                    continue
+                path = os.path.normpath(os.path.join(repo_dir,
+                                                     package['location']))
+                expected.setdefault(path, package)
+
+        report = {'repositories': len(repos), 'packages': len(expected),
+                  'hashed': 0, 'bytes': 0, 'corrupt': [], 'missing': [],
+                  'orphaned': sorted(rpms - set(expected))}
+
+        # Size is checked first; only changed files are hashed again
+        pending = []
+        for path, package in sorted(expected.items()):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                report['missing'].append(path)
+                continue
+            except OSError as e:
+                report['corrupt'].append((path, str(e)))
+                continue
+            if package['size'] is not None and st.st_size != package['size']:
+                report['corrupt'].append(
+                    (path, 'size ' + str(st.st_size) + ', expected ' +
+                     str(package['size'])))
+                continue
+            key = (st.st_dev, st.st_ino, package['checksum_type'] or 'sha256')
+            row = self.db.execute(
+                'SELECT digest FROM audit_cache WHERE device = ? AND '
+                'inode = ? AND algorithm = ? AND size = ? AND mtime = ?',
+                key + (st.st_size, st.st_mtime_ns)).fetchone()
+            if row is not None:
+                self.check(report, path, package, row['digest'])
+                continue
+            pending.append((path, package, key, st))
+
+        # Hardlinked copies share an inode, so each is hashed once
+        unique = {}
+        for path, package, key, st in pending:
+            unique.setdefault(key, path)
+        keys = list(unique)
+        digests = {}
+        if keys:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                digests = dict(zip(keys, executor.map(
+                    hash_package, [unique[key] for key in keys],
+                    [key[2] for key in keys], chunksize=AUDIT_CHUNKS)))
+
+        cached = []
+        for path, package, key, st in pending:
+            digest = digests[key]
+            if digest is None:
+                report['corrupt'].append((path, 'could not be read'))
+                continue
+            if unique[key] == path:
+                report['hashed'] += 1
+                report['bytes'] += st.st_size
+                cached.append(key + (st.st_size, st.st_mtime_ns, digest))
+            self.check(report, path, package, digest)
+
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO audit_cache (device, inode, '
+                'algorithm, size, mtime, digest) VALUES (?, ?, ?, ?, ?, ?)',
+                cached)
+
+        report['corrupt'].sort()
+        return report
+
+    def check(self, report, path, package, digest):
+        if package['checksum'] and digest != package['checksum']:
+            report['corrupt'].append((path, 'checksum mismatch'))
+
+    def close(self):
+        self.db.close()
+
+
+def print_diff(changes):
+    for package in changes['added']:
+        print('+ ' + package['name'] + '-' + evr(package) + '.' +
+              package['arch'])
+    for package in changes['removed']:
+        print('- ' + package['name'] + '-' + evr(package) + '.' +
+              package['arch'])
+    for package in changes['updated']:
+        print('~ ' + package['name'] + '.' + package['arch'] + ' ' +
+              ', '.join(package['old']) + ' -> ' + package['new'])
+    print(str(len(changes['added'])) + ' added, ' +
+          str(len(changes['removed'])) + ' removed, ' +
+          str(len(changes['updated'])) + ' updated.')
+
+
+def print_plan(plan):
+    for package in plan['download']:
+        print('get ' + (package['location'] or package['name']))
+    for package in plan['delete']:
+        print('del ' + (package['location'] or package['name']))
+    print(str(len(plan['download'])) + ' to download (' +
+          str(plan['bytes'] // (1024 * 1024)) + ' MiB), ' +
+          str(len(plan['delete'])) + ' to delete.')
+
+
+def print_audit(report, elapsed):
+    for path, reason in report['corrupt']:
+        print('corrupt ' + path + ': ' + reason)
+    for path in report['missing']:
+        print('missing ' + path)
+    for path in report['orphaned']:
+        print('orphaned ' + path)
+    print(str(report['packages']) + ' packages in ' +
+          str(report['repositories']) + ' repositories, ' +
+          str(report['hashed']) + ' hashed (' +
+          str(report['bytes'] // (1024 * 1024)) + ' MiB) in ' +
+          str(round(elapsed, 1)) + 's: ' + str(len(report['corrupt'])) +
+          ' corrupt, ' + str(len(report['missing'])) + ' missing, ' +
+          str(len(report['orphaned'])) + ' orphaned.')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Index repodata and compare repository snapshots.')
+    parser.add_argument('--db', default=INDEX_DB,
+                        help='SQLite file holding the index')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    index = commands.add_parser('index', help='index a repodata directory')
+    index.add_argument('repo')
+    index.add_argument('label')
+    index.add_argument('path', help='directory that holds repodata/')
+
+    diff = commands.add_parser('diff', help='compare two snapshots')
+    diff.add_argument('repo')
+    diff.add_argument('old')
+    diff.add_argument('new')
+
+    plan = commands.add_parser('plan',
+                               help='list what syncing upstream would do')
+    plan.add_argument('repo')
+    plan.add_argument('local')
+    plan.add_argument('upstream')
+
+    snapshots = commands.add_parser('list', help='list indexed snapshots')
+    snapshots.add_argument('repo', nargs='?')
+
+    audit = commands.add_parser('audit',
+                                help='check packages against their repodata')
+    audit.add_argument('root', nargs='?', default=REPO_ROOT_DIR)
+    audit.add_argument('-w', '--workers', type=int,
+                       help='processes hashing packages (default: one per '
+                       'CPU)')
+
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    index = repodataindex(args.db)
+
+    try:
+        if args.command == 'index':
+            start = time.monotonic()
+            count = index.index(args.repo, args.label, args.path)
+            if count is None:
+                print(args.repo + ' ' + args.label + ': metadata unchanged.')
+            else:
+                print(args.repo + ' ' + args.label + ': indexed ' +
+                      str(count) + ' packages in ' +
+                      str(round(time.monotonic() - start, 2)) + 's.')
+        elif args.command == 'diff':
+            print_diff(index.diff(args.repo, args.old, args.new))
+        elif args.command == 'plan':
+            print_plan(index.plan(args.repo, args.local, args.upstream))
+        elif args.command == 'audit':
+            start = time.monotonic()
+            report = index.audit(args.root, args.workers)
+            print_audit(report, time.monotonic() - start)
+            if report['corrupt'] or report['missing']:
+                sys.exit(2)
+        else:
+            for snapshot in index.snapshots(args.repo):
+                print(snapshot['repo'] + '\t' + snapshot['label'] + '\t' +
+                      str(snapshot['packages']) + ' packages\t' +
+                      str((snapshot['size'] or 0) // (1024 * 1024)) +
+                      ' MiB')
+    except (KeyError, ValueError, OSError, ET.ParseError) as e:
+        print(e.args[0] if isinstance(e, KeyError) else e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        index.close()
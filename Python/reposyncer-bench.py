@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+__author__ = 'Bradley Frank'
+
+import argparse
+import contextlib
+import hashlib
+import http.server
+import importlib.util
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shlex
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = [1, 10, 100, 500]
+ASSET_SIZE = 256 * 1024
+LATENCY = 0.02
+STUB_DELAY = 0.5
+
+STUB_REPOSYNC = '''#!/bin/sh
+# Stand-in for reposync: wait, then create the download path
+while [ $# -gt 0 ]; do
+    [ "$1" = "-p" ] && path="$2"
+    shift
+done
+sleep {delay}
+mkdir -p "$path"
+'''
+
+STUB_CREATEREPO = '''#!/bin/sh
+# Stand-in for createrepo: wait, then write empty metadata
+for path; do :; done
+sleep {delay}
+mkdir -p "$path/repodata"
+touch "$path/repodata/repomd.xml"
+'''
+
+STUB_RPMKEYS = '''#!/bin/sh
+# Stand-in for rpmkeys: accept every package
+echo "$2: digests OK"
+'''
+
+
+def rpm_headers(name):
+    # Lead, empty signature header and a main header the index can read
+    def section(tags):
+        entries = b''
+        data = b''
+        for tag, value in tags:
+            entries += struct.pack('>iiii', tag, 6, len(data), 1)
+            data += value.encode('utf-8') + b'\0'
+        return b'\x8e\xad\xe8\x01\0\0\0\0' + \
+            struct.pack('>II', len(tags), len(data)) + entries + data
+
+    header = section([(1000, name), (1001, '1.0'), (1002, '1'),
+                      (1022, 'x86_64'), (1044, name + '-1.0-1.src.rpm')])
+    return b'\xed\xab\xee\xdb' + b'\0' * 92 + section([]) + header
+
+
+class fakegithub:
+
+    def __init__(self, count, asset_size, latency):
+        self.asset_size = asset_size
+        self.latency = latency
+        self.projects = {'project' + str(i): ['bench', 'project' + str(i)]
+                         for i in range(count)}
+        self.digests = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'not_modified': 0, 'bytes': 0}
+
+    def asset(self, repo):
+        # Every project gets different content so the store cannot dedupe it
+        block = hashlib.sha256(repo.encode('utf-8')).digest() * 2048
+        data = rpm_headers(repo) + block * (self.asset_size // len(block) + 1)
+        return data[:self.asset_size]
+
+    def digest(self, repo):
+        if repo not in self.digests:
+            self.digests[repo] = hashlib.sha256(self.asset(repo)).hexdigest()
+        return self.digests[repo]
+
+    def feed(self, repo):
+        rpm_name = repo + '-1.0-1.x86_64.rpm'
+        return {
+            'tag_name': 'v1.0',
+            'assets': [{
+                'name': rpm_name,
+                'size': self.asset_size,
+                'digest': 'sha256:' + self.digest(repo),
+                'browser_download_url': self.url + '/download/' + repo + '/' +
+                rpm_name,
+            }],
+        }
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def start(self):
+        github = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                github.count('bytes', len(body))
+
+            def do_GET(self):
+                github.count('requests')
+                time.sleep(github.latency)
+
+                # Release feeds with an ETag per project
+                match = re.match(r'^/repos/[^/]+/([^/]+)/releases/latest$',
+                                 self.path)
+                if match:
+                    repo = match.group(1)
+                    etag = '"' + github.digest(repo)[:16] + '"'
+                    if self.headers.get('If-None-Match') == etag:
+                        github.count('not_modified')
+                        return self.reply(304, headers={'ETag': etag})
+                    body = json.dumps(github.feed(repo)).encode('utf-8')
+                    return self.reply(200, body, {'ETag': etag})
+
+                # Release assets with byte range support
+                match = re.match(r'^/download/([^/]+)/', self.path)
+                if match:
+                    data = github.asset(match.group(1))
+                    headers = {'Accept-Ranges': 'bytes'}
+                    byte_range = re.match(r'bytes=(\d+)-(\d*)',
+                                          self.headers.get('Range', ''))
+                    if not byte_range:
+                        return self.reply(200, data, headers)
+                    start = int(byte_range.group(1))
+                    end = int(byte_range.group(2) or len(data) - 1)
+                    headers['Content-Range'] = 'bytes ' + str(start) + '-' + \
+                        str(end) + '/' + str(len(data))
+                    return self.reply(206, data[start:end + 1], headers)
+
+                self.reply(404)
+
+            def do_POST(self):
+                github.count('requests')
+                time.sleep(github.latency)
+
+                # Batched GraphQL release lookups
+                length = int(self.headers.get('Content-Length', 0))
+                query = json.loads(self.rfile.read(length))['query']
+                data = {}
+                for alias, repo in re.findall(
+                        r'(p\d+): repository\(owner: "[^"]+", name: "([^"]+)"',
+                        query):
+                    asset = github.feed(repo)['assets'][0]
+                    data[alias] = {'latestRelease': {'releaseAssets': {
+                        'nodes': [{'name': asset['name'],
+                                   'downloadUrl': asset['browser_download_url'],
+                                   'size': asset['size']}]}}}
+                body = json.dumps({'data': data}).encode('utf-8')
+                self.reply(200, body)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def load_script(name):
+    # Scripts are not packages, so import them straight from their files
+    path = os.path.join(SCRIPT_DIR, name)
+    spec = importlib.util.spec_from_file_location(
+        name[:-3].replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+
+    # Worker processes look functions up by module name
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def install_stubs(bin_dir, delay):
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, script in (('reposync', STUB_REPOSYNC),
+                         ('createrepo', STUB_CREATEREPO),
+                         ('rpmkeys', STUB_RPMKEYS)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(script.format(delay=delay))
+        os.chmod(path, 0o755)
+
+
+def timed(phases, phase, func):
+    start = time.monotonic()
+    func()
+    phases[phase] = time.monotonic() - start
+
+
+def bench_reposyncer(url, root, projects, script_args):
+    reposyncer = load_script('reposyncer.py')
+    reposyncer.GITHUB_URL = url + '/repos/'
+    reposyncer.GITHUB_GRAPHQL_URL = url + '/graphql'
+    reposyncer.REPO_ROOT_DIR = root
+    reposyncer.REPOSYNC_CONF_DIR = os.path.join(root, 'conf')
+    reposyncer.CREATEREPO_CACHE_DIR = os.path.join(root, 'cache')
+    reposyncer.PROJECTS = projects
+
+    args = reposyncer.parse_args(
+        ['--feed-cache', os.path.join(root, 'cache', 'feeds.json')] +
+        script_args)
+
+    phases = {}
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            repolog = reposyncer.myLogger(False)
+            store = None
+            if args.store:
+                store = reposyncer.packagestore(
+                    os.path.join(root, reposyncer.REPO_STORE), repolog)
+
+            # Time of day must not change results, so only limit on request
+            profiles = []
+            if args.bandwidth:
+                profiles = [(0, 24, args.bandwidth)]
+            scheduler = reposyncer.transferscheduler(args.max_transfers,
+                                                     profiles, repolog)
+
+            verifier = None
+            if not args.no_verify:
+                verifier = reposyncer.rpmverifier(
+                    os.path.join(root, reposyncer.REPO_QUARANTINE),
+                    args.verify_workers, args.require_signature, repolog)
+
+            timed(phases, 'rpm2repo',
+                  lambda: reposyncer._rpm2repo(args, repolog, store,
+                                               scheduler, verifier))
+            if verifier:
+                verifier.close()
+            timed(phases, 'reposync',
+                  lambda: reposyncer._reposyncer(args, repolog, store,
+                                                 scheduler))
+            timed(phases, 'createrepo',
+                  lambda: reposyncer._repocreator(args, repolog))
+            repolog.close()
+
+    return phases
+
+
+def bench_make_local_repo(url, root, projects, script_args):
+    make_local_repo = load_script('make-local-repo.py')
+    download_dir = os.path.join(root, 'yum2')
+    os.makedirs(download_dir, exist_ok=True)
+    make_local_repo.GITHUB_URL = url + '/repos/'
+    make_local_repo.DOWNLOAD_DIR = download_dir
+    make_local_repo.FEED_CACHE = os.path.join(download_dir, '.feeds.json')
+    make_local_repo.MANIFEST_FILE = os.path.join(download_dir, '.manifest.json')
+    make_local_repo.CREATEREPO_CACHE_DIR = os.path.join(download_dir, '.cache')
+
+    def update():
+        cache = make_local_repo.load_feed_cache(repolog)
+        for name, repo in projects.items():
+            make_local_repo.get_latest_release(name, repo[0], repo[1], cache,
+                                               repolog)
+        make_local_repo.save_feed_cache(cache, repolog)
+
+    phases = {}
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            repolog = make_local_repo.myLogger(False)
+            timed(phases, 'update', update)
+            timed(phases, 'createrepo',
+                  lambda: make_local_repo.createrepo(repolog))
+            repolog.close()
+
+    return phases
+
+
+def run_pass(bench, url, root, projects, script_args, results):
+    # Runs in a fresh interpreter so peak memory belongs to one pass
+    os.environ['PATH'] = os.path.join(root, 'bin') + os.pathsep + \
+        os.environ['PATH']
+    phases = bench(url, root, projects, script_args)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({'phases': phases, 'peak_rss': peak * 1024})
+
+
+def run_scenario(script, count, options):
+    github = fakegithub(count, options.size, options.latency)
+    github.start()
+    root = tempfile.mkdtemp(prefix='reposyncer-bench-')
+    install_stubs(os.path.join(root, 'bin'), options.stub_delay)
+    bench = {'reposyncer': bench_reposyncer,
+             'make-local-repo': bench_make_local_repo}[script]
+
+    # A cold pass fills the caches that the warm pass should benefit from
+    report = []
+    context = multiprocessing.get_context('spawn')
+    try:
+        for run in ('cold', 'warm'):
+            before = dict(github.stats)
+            results = context.Queue()
+            process = context.Process(
+                target=run_pass,
+                args=(bench, github.url, root, github.projects,
+                      shlex.split(options.script_args), results))
+            process.start()
+            result = results.get()
+            process.join()
+
+            result.update({
+                'script': script,
+                'projects': count,
+                'pass': run,
+                'requests': github.stats['requests'] - before['requests'],
+                'not_modified': github.stats['not_modified'] -
+                before['not_modified'],
+                'bytes': github.stats['bytes'] - before['bytes'],
+            })
+            report.append(result)
+    finally:
+        github.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    return report
+
+
+def print_report(report):
+    print('%-16s %8s %5s %-11s %9s %9s %8s %6s %9s' % (
+        'script', 'projects', 'pass', 'phase', 'seconds', 'MiB/s',
+        'requests', '304s', 'peak MiB'))
+
+    for result in report:
+        for i, (phase, seconds) in enumerate(result['phases'].items()):
+            if i > 0:
+                print('%-16s %8d %5s %-11s %9.3f' % (
+                    result['script'], result['projects'], result['pass'],
+                    phase, seconds))
+                continue
+
+            # Transfers all happen in the first phase of each script
+            throughput = 0.0
+            if seconds > 0:
+                throughput = result['bytes'] / seconds / 2 ** 20
+            print('%-16s %8d %5s %-11s %9.3f %9.1f %8d %6d %9.1f' % (
+                result['script'], result['projects'], result['pass'], phase,
+                seconds, throughput, result['requests'],
+                result['not_modified'], result['peak_rss'] / 2 ** 20))
+
+if __name__ == '__main__':
+    # Set available arguments
+    parser = argparse.ArgumentParser(
+        description='Offline benchmark for reposyncer and make-local-repo.')
+    parser.add_argument('-p', '--projects', type=int, nargs='+',
+                        default=SCENARIOS,
+                        help='project counts to benchmark')
+    parser.add_argument('--scripts', nargs='+',
+                        choices=['reposyncer', 'make-local-repo'],
+                        default=['reposyncer', 'make-local-repo'],
+                        help='scripts to benchmark')
+    parser.add_argument('-s', '--size', type=int, default=ASSET_SIZE,
+                        help='size of each release asset in bytes')
+    parser.add_argument('-l', '--latency', type=float, default=LATENCY,
+                        help='seconds the fake API waits per request')
+    parser.add_argument('--stub-delay', type=float, default=STUB_DELAY,
+                        help='seconds the reposync/createrepo stubs take')
+    parser.add_argument('-a', '--script-args', default='',
+                        help='extra arguments passed to reposyncer')
+    parser.add_argument('-o', '--output',
+                        help='also write results to this JSON file')
+    options = parser.parse_args()
+
+    report = []
+    for script in options.scripts:
+        for count in options.projects:
+            report += run_scenario(script, count, options)
+
+    print_report(report)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
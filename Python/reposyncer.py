@@ -3,72 +3,718 @@
 __author__ = 'Bradley Frank'
 
 import argparse
+import atexit
+import collections
+import configparser
+import contextlib
+import functools
+import hashlib
+import heapq
+import http.client
+import itertools
 import json
 import logging
+import logging.handlers
+import mmap
 import os
+import queue
+import re
 import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.error import URLError
+
+try:
+    import repoindex
+except ImportError:
+    repoindex = None
 
 PROJECTS = {
     'Mailspring': ['Foundry376', 'Mailspring'],
     'VSCodium': ['VSCodium', 'vscodium'],
 }
 
+GITHUB_URL = 'https://api.github.com/repos/'
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+GRAPHQL_BATCH_SIZE = 50
+FEED_CACHE = '/var/cache/reposyncer/feeds.json'
+
 REPO_ROOT_DIR = '/srv/repos'
 REPO_COLO = 'colo'
+REPO_STORE = '.store'
+REPO_QUARANTINE = '.quarantine'
+REPO_SNAPSHOTS = 'snapshots'
+REPO_CURRENT = 'current'
 REPOSITORIES = {
     'CentOS': '7',
     'Fedora': '29'
 }
 
+REPOSYNC_CONF_DIR = '/etc/reposyncer.d/'
+MIRROR_CACHE = '/var/cache/reposyncer/mirrors.json'
+CREATEREPO_CACHE_DIR = '/var/cache/reposyncer/createrepo'
+MANIFEST_NAME = '.manifest.json'
+RPM_INDEX_NAME = '.rpmindex.json'
+INDEX_DB = '/var/cache/reposyncer/index.sqlite'
+
+# Release assets that publish checksums for the other assets
+CHECKSUM_REGEX = re.compile(
+    r'(sha256sums?|checksums?)(\.txt)?$|\.sha256(sum)?$', re.IGNORECASE)
+
 PACKAGES = {}
+SNAPSHOTS = {}
+
+# RPM files start with a lead, then the signature and main headers
+RPM_LEAD_SIZE = 96
+RPM_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+RPM_HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+RPM_TAGS = {
+    1000: 'name',
+    1001: 'version',
+    1002: 'release',
+    1003: 'epoch',
+    1022: 'arch',
+    1044: 'sourcerpm',
+}
+RPM_SIGTAG_SHA256 = 273
+RPM_INT32 = 4
+RPM_STRINGS = (6, 8, 9)
+
+# reposync prints "(12/3456): name.rpm | 1.2 MB 00:01" for each package
+PROGRESS_REGEX = re.compile(
+    r'\((\d+)/(\d+)\):[^|]*(?:\|\s*([\d.]+)\s*([kMG]?B)\b)?')
+# createrepo prints "12/3456 - name.rpm" or a total after the directory walk
+COUNT_REGEX = re.compile(r'^(\d+)/(\d+) - ')
+TOTAL_REGEX = re.compile(r'walk done - (\d+) packages')
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+PROGRESS_INTERVAL = 30
+STOP_INTERVAL = 1
+OUTPUT_TAIL = 20
+
+MAX_WORKERS = 4
+CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+# Seconds a connection may stall before the request is retried
+DOWNLOAD_TIMEOUT = 60
+SEGMENT_MIN_SIZE = 32 * 1024 * 1024
+VERIFY_WORKERS = 2
+SYNC_WORKERS = 2
+REPOSYNC_TIMEOUT = 6 * 60 * 60
+KEEP_RELEASES = 3
+KEEP_SNAPSHOTS = 3
+POLL_INTERVAL = 5 * 60
+POLL_BACKOFF = 2
+MAX_POLL_INTERVAL = 6 * 60 * 60
+SYNC_INTERVAL = 24 * 60 * 60
+
+# Mirrors listed in a baseurl are ranked by fetching a small sample
+MIRROR_SAMPLE = 'repodata/repomd.xml'
+MIRROR_TIMEOUT = 10
+MIRROR_TTL = 6 * 60 * 60
+# Mirrors are compared on the time to fetch a package of this size
+MIRROR_SCORE_SIZE = 512 * 1024
+
+# (start hour, end hour, bytes per second); other hours are unlimited
+BANDWIDTH_PROFILES = [
+    (8, 18, 4 * 1024 * 1024),
+]
+MAX_TRANSFERS = 4
+
+# Lower numbers get a transfer slot first
+PRIORITY_DOWNLOAD = 10
+PRIORITY_SYNC = 50
+PRIORITIES = {}
+
+
+def rpmvercmp(a, b):
+    # Port of rpmvercmp() from librpm, including ~ and ^ handling
+    if a == b:
+        return 0
+
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while i < len(a) and not a[i].isalnum() and a[i] not in '~^':
+            i += 1
+        while j < len(b) and not b[j].isalnum() and b[j] not in '~^':
+            j += 1
+
+        # Tilde sorts before everything, even the end of the string
+        if a[i:i + 1] == '~' or b[j:j + 1] == '~':
+            if a[i:i + 1] != '~':
+                return 1
+            if b[j:j + 1] != '~':
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        # Caret sorts after the end of the string but before anything else
+        if a[i:i + 1] == '^' or b[j:j + 1] == '^':
+            if i >= len(a):
+                return -1
+            if j >= len(b):
+                return 1
+            if a[i] != '^':
+                return 1
+            if b[j] != '^':
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        if i >= len(a) or j >= len(b):
+            break
+
+        # Compare the next numeric or alphabetic segment of each
+        isnum = a[i].isdigit()
+        test = str.isdigit if isnum else str.isalpha
+        start_a, start_b = i, j
+        while i < len(a) and a[i].isascii() and test(a[i]):
+            i += 1
+        while j < len(b) and b[j].isascii() and test(b[j]):
+            j += 1
+        seg_a, seg_b = a[start_a:i], b[start_b:j]
+
+        # Numeric segments are newer than alphabetic ones
+        if not seg_b:
+            return 1 if isnum else -1
+
+        if isnum:
+            seg_a = seg_a.lstrip('0')
+            seg_b = seg_b.lstrip('0')
+            if len(seg_a) != len(seg_b):
+                return 1 if len(seg_a) > len(seg_b) else -1
+        if seg_a != seg_b:
+            return 1 if seg_a > seg_b else -1
+
+    if i >= len(a) and j >= len(b):
+        return 0
+    return 1 if i < len(a) else -1
+
+
+def label_compare(evr_a, evr_b):
+    # Compare (epoch, version, release) tuples in RPM order
+    for part_a, part_b in zip(evr_a, evr_b):
+        result = rpmvercmp(part_a or '0', part_b or '0')
+        if result != 0:
+            return result
+
+    return 0
+
+
+def parse_rpm_filename(filename):
+    # name-version-release.arch.rpm; the epoch is not part of the filename
+    if not filename.endswith('.rpm'):
+        return None
+    nvr, _, arch = filename[:-4].rpartition('.')
+    parts = nvr.rsplit('-', 2)
+    if not arch or len(parts) != 3 or not all(parts):
+        return None
+
+    return {'name': parts[0], 'epoch': '0', 'version': parts[1],
+            'release': parts[2], 'arch': arch}
+
+
+def read_header_section(buf, offset):
+    # Magic, reserved, entry count, data size, then 16 byte entries
+    if buf[offset:offset + 4] != RPM_HEADER_MAGIC:
+        raise ValueError('bad header magic at offset ' + str(offset))
+    count, size = struct.unpack('>II', buf[offset + 8:offset + 16])
+    data = offset + 16 + count * 16
+    if data + size > len(buf):
+        raise ValueError('header is truncated')
+
+    entries = {}
+    for i in range(count):
+        tag, kind, start, items = struct.unpack(
+            '>iiii', buf[offset + 16 + i * 16:offset + 32 + i * 16])
+        entries[tag] = (kind, data + start)
+
+    return entries, data + size
+
+
+def header_value(buf, entry):
+    kind, start = entry
+    if kind == RPM_INT32:
+        return str(struct.unpack('>i', buf[start:start + 4])[0])
+    if kind in RPM_STRINGS:
+        end = buf.find(b'\0', start)
+        return buf[start:end].decode('utf-8', 'replace')
+    return None
+
+
+def read_rpm_header(path):
+    # Only the pages holding the headers are read, never the payload
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if buf[:4] != RPM_LEAD_MAGIC:
+                raise ValueError(path + ' is not an RPM')
+            signature, end = read_header_section(buf, RPM_LEAD_SIZE)
+            header, end = read_header_section(buf, end + (-end % 8))
+
+            package = {'epoch': '0'}
+            for tag, field in RPM_TAGS.items():
+                if tag in header:
+                    package[field] = header_value(buf, header[tag])
+            if RPM_SIGTAG_SHA256 in signature:
+                package['header_sha256'] = header_value(
+                    buf, signature[RPM_SIGTAG_SHA256])
+
+    # Source packages are the ones not built from a source package
+    if 'sourcerpm' not in package:
+        package['arch'] = 'src'
+    package.pop('sourcerpm', None)
+    for field in ('name', 'version', 'release', 'arch'):
+        if not package.get(field):
+            raise ValueError(path + ' has no ' + field + ' tag')
+
+    return package
+
+
+def sha256_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def verify_package(path, checksum=None, require_signature=False):
+    # Runs in a worker process, so it only takes and returns plain values
+    if checksum:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        if sha256.hexdigest() != checksum:
+            return False, 'does not match the published checksum'
+
+    try:
+        result = subprocess.run(['rpmkeys', '--checksig', path],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+    except OSError as e:
+        return False, 'could not run rpmkeys: ' + str(e)
+
+    # rpmkeys prints "name.rpm: digests signatures OK" for signed packages
+    output = result.stdout.strip()
+    if result.returncode != 0:
+        return False, output
+    if require_signature and \
+            'signatures' not in output.rsplit(':', 1)[-1]:
+        return False, 'package is not signed'
+
+    return True, output
+
+
+class transferscheduler:
+
+    def __init__(self, max_transfers, profiles, repolog):
+        self.max_transfers = max_transfers
+        self.profiles = profiles
+        self.repolog = repolog
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = []
+        self.tickets = itertools.count()
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def rate(self):
+        # Bytes per second allowed right now, or None for no limit
+        hour = time.localtime().tm_hour
+        for start, end, rate in self.profiles:
+            if start <= hour < end or (start > end and
+                                       (hour >= start or hour < end)):
+                return rate
+
+        return None
+
+    def share(self):
+        # What one transfer gets when every slot is busy
+        rate = self.rate()
+        if rate is None:
+            return None
+
+        return max(1, rate // self.max_transfers)
+
+    @contextlib.contextmanager
+    def transfer(self, priority):
+        # Lowest priority number goes first, then first come first served
+        ticket = (priority, next(self.tickets))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            while self.active >= self.max_transfers or \
+                    self.waiting[0] != ticket:
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.active += 1
+            self.condition.notify_all()
+
+        try:
+            yield self
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def throttle(self, nbytes):
+        # Token bucket shared by every transfer in flight
+        rate = self.rate()
+        if rate is None:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(rate, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= nbytes
+            delay = -self.tokens / rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class commandprogress:
+
+    def __init__(self, stage, name, repolog):
+        self.stage = stage
+        self.name = name
+        self.repolog = repolog
+        self.packages = 0
+        self.total = None
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.last_output = self.started
+        self.output = collections.deque(maxlen=OUTPUT_TAIL)
+
+    def feed(self, line):
+        line = line.rstrip()
+        if not line:
+            return
+        self.output.append(line)
+        self.last_output = time.monotonic()
+        self.repolog.log('debug', self.name + ': ' + line)
+
+        match = PROGRESS_REGEX.search(line)
+        if match:
+            self.packages = int(match.group(1))
+            self.total = int(match.group(2))
+            if match.group(3):
+                self.bytes += int(float(match.group(3)) *
+                                  SIZE_UNITS[match.group(4).upper()])
+            return
+
+        match = COUNT_REGEX.search(line)
+        if match:
+            self.packages = int(match.group(1))
+            self.total = int(match.group(2))
+            return
+
+        match = TOTAL_REGEX.search(line)
+        if match:
+            self.total = int(match.group(1))
+
+    def stats(self, state='running'):
+        now = time.monotonic()
+        elapsed = now - self.started
+        rate = self.packages / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total and rate:
+            eta = round((self.total - self.packages) / rate)
+
+        return {
+            'state': state,
+            'packages': self.packages,
+            'total': self.total,
+            'bytes': self.bytes,
+            'rate': round(rate, 2),
+            'eta': eta,
+            'elapsed': round(elapsed),
+            'idle': round(now - self.last_output),
+        }
+
+    def report(self, state='running'):
+        stats = self.stats(state)
+        self.repolog.progress(self.stage, self.name, stats)
+
+        message = self.name + ': ' + str(stats['packages'])
+        if stats['total']:
+            message += '/' + str(stats['total'])
+        message += ' packages, ' + str(stats['bytes'] // (1024 * 1024)) + \
+            ' MiB, ' + str(stats['rate']) + ' packages/s'
+        if stats['eta'] is not None and state == 'running':
+            message += ', ETA ' + str(stats['eta']) + 's'
+        if stats['idle'] >= PROGRESS_INTERVAL:
+            message += ', no output for ' + str(stats['idle']) + 's'
+        self.repolog.log('info', message + '.')
+
+
+def run_command(command, progress, timeout=None, stop=None):
+    # Output is read on its own thread so a stalled command still reports
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               universal_newlines=True, errors='replace')
+    reader = threading.Thread(target=lambda: [progress.feed(line)
+                                              for line in process.stdout])
+    reader.start()
+
+    # A stop event is checked every STOP_INTERVAL instead of only when
+    # progress is reported
+    deadline = None if timeout is None else time.monotonic() + timeout
+    next_report = time.monotonic() + PROGRESS_INTERVAL
+    while True:
+        try:
+            returncode = process.wait(STOP_INTERVAL if stop
+                                      else PROGRESS_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            stopped = stop is not None and stop.is_set()
+            if stopped or deadline and time.monotonic() >= deadline:
+                process.kill()
+                process.wait()
+                reader.join()
+                progress.report('stopped' if stopped else 'timeout')
+                raise
+            if time.monotonic() >= next_report:
+                progress.report()
+                next_report += PROGRESS_INTERVAL
+
+    reader.join()
+    progress.report('done' if returncode == 0 else 'failed')
+
+    # Show what the command said before it failed
+    if returncode != 0:
+        for line in progress.output:
+            progress.repolog.log('error', progress.name + ': ' + line)
+
+    return returncode
+
+
+class feedcache:
+
+    def __init__(self, cache_file, repolog):
+        self.cache_file = cache_file
+        self.repolog = repolog
+        self.lock = threading.Lock()
+        self.feeds = {}
+
+        # Load validators and assets saved by the previous run
+        try:
+            with open(self.cache_file) as f:
+                self.feeds = json.load(f)
+        except (IOError, ValueError) as e:
+            self.repolog.log('debug', 'Feed cache not loaded: ' + str(e))
+
+    def get(self, name):
+        with self.lock:
+            return self.feeds.get(name, {})
+
+    def set(self, name, entry):
+        with self.lock:
+            self.feeds[name] = entry
+
+    def save(self):
+        # Write to a temporary file so an interrupted save keeps the old cache
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with self.lock:
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.feeds, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            self.repolog.log('error', 'Could not save feed cache: ' + str(e))
+            return False
+
+        return True
+
+
+class releasebatch:
+
+    def __init__(self, projects, token, repolog):
+        self.projects = projects
+        self.token = token
+        self.repolog = repolog
+
+    def build_query(self, names):
+        # One aliased repository lookup per project
+        lookups = []
+        for i, name in enumerate(names):
+            owner, repo = self.projects[name]
+            lookups.append(
+                'p' + str(i) + ': repository(owner: ' + json.dumps(owner) +
+                ', name: ' + json.dumps(repo) + ') { latestRelease { ' +
+                'releaseAssets(first: 100) { nodes { name downloadUrl size } ' +
+                '} } }')
+
+        return 'query { ' + ' '.join(lookups) + ' }'
+
+    def get_assets(self):
+        # Resolve as many projects as possible; the rest fall back to REST
+        assets = {}
+        names = list(self.projects)
+
+        for start in range(0, len(names), GRAPHQL_BATCH_SIZE):
+            batch = names[start:start + GRAPHQL_BATCH_SIZE]
+            body = json.dumps({'query': self.build_query(batch)})
+            request = urllib.request.Request(GITHUB_GRAPHQL_URL,
+                                             data=body.encode('utf-8'))
+            request.add_header('Authorization', 'bearer ' + self.token)
+            request.add_header('Content-Type', 'application/json')
+
+            try:
+                response = urllib.request.urlopen(request,
+                                                  timeout=DOWNLOAD_TIMEOUT)
+                result = json.loads(response.read().decode('utf-8'))
+            except (HTTPError, URLError, socket.timeout, ValueError) as e:
+                self.repolog.log('warning', 'Batched release query failed: ' +
+                                 str(e))
+                continue
+
+            for error in result.get('errors') or []:
+                self.repolog.log('debug',
+                                 'GraphQL: ' + error.get('message', ''))
+
+            data = result.get('data') or {}
+            for i, name in enumerate(batch):
+                repository = data.get('p' + str(i))
+                if not repository or not repository.get('latestRelease'):
+                    continue
+                nodes = repository['latestRelease']['releaseAssets']['nodes']
+                assets[name] = [{'name': node['name'],
+                                 'browser_download_url': node['downloadUrl'],
+                                 'size': node.get('size'),
+                                 'digest': None}
+                                for node in nodes]
+
+        self.repolog.log('info', 'Resolved ' + str(len(assets)) + ' of ' +
+                         str(len(names)) + ' projects in batched queries.')
+        return assets
 
 
 class rpm2repo:
 
-    def __init__(self, name, owner, repo, colo_dir, repolog):
-        self.releases_url = 'https://api.github.com/repos/' + \
-            owner + '/' + repo + '/releases/latest'
+    def __init__(self, name, owner, repo, colo_dir, repolog, cache=None,
+                 segments=1, store=None, scheduler=None, verifier=None,
+                 index=None):
+        self.releases_url = GITHUB_URL + owner + '/' + repo + \
+            '/releases/latest'
         self.colo_dir = colo_dir
         self.name = name
         self.repolog = repolog
+        self.cache = cache
+        self.segments = segments
+        self.store = store
+        self.scheduler = scheduler
+        self.verifier = verifier
+        self.index = index
+        self.priority = PRIORITIES.get(name, PRIORITY_DOWNLOAD)
+
+    def get_release_assets(self):
+        # Send the validators from the last run as a conditional request
+        cached = self.cache.get(self.name) if self.cache else {}
+        request = urllib.request.Request(self.releases_url)
+        if cached.get('etag'):
+            request.add_header('If-None-Match', cached['etag'])
+        if cached.get('last_modified'):
+            request.add_header('If-Modified-Since', cached['last_modified'])
 
-    def get_latest_release(self):
         # Download release feed from GitHub
         try:
-            response = urllib.request.urlopen(self.releases_url)
+            response = urllib.request.urlopen(request,
+                                              timeout=DOWNLOAD_TIMEOUT)
         except HTTPError as e:
-            print(self.name + ': could not download release information.')
+            if e.code == 304 and 'assets' in cached:
+                self.repolog.log('info',
+                                 self.name + ': release feed not modified.')
+                return cached['assets']
+            self.repolog.log('error', self.name +
+                             ': could not download release information.')
             self.repolog.log('error', e.code)
-            return False
+            return None
         except URLError as e:
-            print(self.name + ': could not download release information.')
+            self.repolog.log('error', self.name +
+                             ': could not download release information.')
             self.repolog.log('error', e.reason)
-            return False
+            return None
+        except socket.timeout as e:
+            self.repolog.log('error', self.name +
+                             ': could not download release information.')
+            self.repolog.log('error', e)
+            return None
 
-        self.data = response.readall().decode('utf-8')
-        self.feed = json.loads(self.data)
+        # A dropped connection or a body that is not JSON fails this feed
+        try:
+            self.data = response.read().decode('utf-8')
+            self.feed = json.loads(self.data)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self.repolog.log('error', self.name +
+                             ': could not read release information: ' +
+                             str(e))
+            return None
 
         # Check that feed actually has releases
         if 'assets' not in self.feed:
-            print(self.name + ': could not find release information.')
-            return False
+            self.repolog.log('error', self.name +
+                             ': could not find release information.')
+            return None
         else:
             self.repolog.log('info',
                              self.name + ': downloaded release information.')
 
+        # Keep only what later runs need to find the RPM again
+        assets = [{'name': asset['name'],
+                   'browser_download_url': asset['browser_download_url'],
+                   'size': asset.get('size'),
+                   'digest': asset.get('digest')}
+                  for asset in self.feed['assets']]
+
+        if self.cache:
+            self.cache.set(self.name, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'assets': assets,
+            })
+
+        return assets
+
+    def get_latest_release(self, assets=None):
+        # Assets may already have been resolved by a batched query
+        with self.repolog.span('feed', self.name) as span:
+            if assets is not None:
+                self.assets = assets
+            else:
+                self.assets = self.get_release_assets()
+            span['ok'] = self.assets is not None
+        if self.assets is None:
+            return False
+
         # Search releases for RPM file
-        for asset in self.feed['assets']:
+        for asset in self.assets:
             if asset['name'].endswith('.rpm'):
                 self.download_url = asset['browser_download_url']
                 self.rpm_name = asset['name']
+                self.size = asset.get('size')
+                self.digest = asset.get('digest')
                 self.repolog.log('info',
                                  self.name + ': found latest release RPM.')
                 break
         else:
-            print('RPM file not found.')
+            self.repolog.log('error', 'RPM file not found.')
             return False
 
         # Append new version filename to repo directory
@@ -78,74 +724,905 @@ class rpm2repo:
         if not os.path.isdir(self.colo_dir):
             os.makedirs(self.colo_dir, exist_ok=True)
 
-        # Skip if file already exists
-        if os.path.isfile(self.filename):
-            print(self.name + ': RPM is already at latest release.')
+        # Skip if the repository already has this exact package
+        current = self.current_package()
+        if current:
+            self.repolog.log('info', self.name +
+                             ': RPM is already at latest release.')
+            if current != self.rpm_name:
+                self.repolog.log('debug', self.name + ': ' + self.rpm_name +
+                                 ' is already there as ' + current + '.')
             return False
 
+        # Failed packages stay out until they are removed from quarantine
+        if self.verifier and self.verifier.quarantined(self.rpm_name):
+            self.repolog.log('warning', self.name + ': ' + self.rpm_name +
+                             ' is quarantined.')
+            return False
+
+        # Link the RPM from the store if another repository already has it
+        if self.store and self.digest and self.digest.startswith('sha256:') \
+                and self.store.link(self.digest[7:], self.filename):
+            if self.index:
+                self.index.add(self.rpm_name, self.digest[7:])
+            self.repolog.log('info', self.name +
+                             ': linked latest release from the store.')
+            return True
+
         # Download the actual RPM file
-        try:
-            response = urllib.request.urlopen(self.download_url)
-        except HTTPError as e:
-            print('Could not download release.')
-            self.repolog.log('error', e.code)
+        with self.repolog.span('download', self.name) as span:
+            if self.scheduler:
+                with self.scheduler.transfer(self.priority):
+                    downloaded = self.download_release()
+            else:
+                downloaded = self.download_release()
+            span.update(ok=downloaded, bytes=self.transferred)
+        if not downloaded:
             return False
-        except URLError as e:
-            print('Could not download release.')
-            self.repolog.log('error', e.reason)
+
+        # Verify while the other downloads carry on; the package is moved
+        # into the repository and indexed only once it passes
+        if self.verifier:
+            self.verifier.submit(self.name, self.filename + '.part',
+                                 self.get_upstream_checksum(), self.filename)
+        else:
+            if self.index:
+                self.index.add(self.rpm_name, self.checksum)
+            if self.store:
+                self.store.add(self.filename, self.checksum)
+
+        self.repolog.log('info', self.name + ': updated to latest release.')
+        return True
+
+    def current_package(self):
+        # Without an index only the asset filename can be checked
+        if not self.index:
+            return self.rpm_name if os.path.isfile(self.filename) else None
+
+        # Content identifies the package, whatever the asset is called
+        if self.digest and self.digest.startswith('sha256:'):
+            return self.index.find(self.digest[7:])
+
+        # Without a digest, the same name and size is the best evidence
+        package = self.index.get(self.rpm_name)
+        if package and (not self.size or package['size'] == self.size):
+            return self.rpm_name
+        return None
+
+    def get_upstream_checksum(self):
+        # Projects may publish a SHA256SUMS file or a .sha256 per asset
+        for asset in self.assets:
+            if not CHECKSUM_REGEX.search(asset['name']):
+                continue
+            try:
+                response = urllib.request.urlopen(
+                    asset['browser_download_url'], timeout=DOWNLOAD_TIMEOUT)
+                lines = response.read().decode('utf-8').splitlines()
+            except (HTTPError, URLError, socket.timeout,
+                    UnicodeDecodeError) as e:
+                self.repolog.log('warning', self.name + ': could not read ' +
+                                 asset['name'] + ': ' + str(e))
+                continue
+
+            for line in lines:
+                fields = line.split()
+                if len(fields) == 1 and \
+                        asset['name'].startswith(self.rpm_name):
+                    return fields[0].lower()
+                if len(fields) == 2 and fields[1].lstrip('*') == self.rpm_name:
+                    return fields[0].lower()
+
+        return None
+
+    def download_release(self):
+        part_file = self.filename + '.part'
+        self.transferred = 0
+
+        # A segmented download that was killed has holes, so start over
+        segments_file = self.filename + '.segments'
+        if os.path.isfile(segments_file):
+            os.remove(segments_file)
+
+        # Large assets are split over several connections
+        sha256 = None
+        if self.segments > 1 and self.size and \
+                self.size >= SEGMENT_MIN_SIZE and \
+                not os.path.isfile(part_file):
+            sha256 = self.download_segments(part_file)
+        if sha256 is None:
+            sha256 = self.download_stream(part_file)
+        if sha256 is None:
+            self.repolog.log('error', self.name + ': could not save ' +
+                             self.rpm_name + '.')
             return False
 
-        # Save the RPM file to disk
+        # Never publish a file that does not match the release asset
+        self.checksum = sha256.hexdigest()
+        if self.size and os.path.getsize(part_file) != self.size:
+            self.repolog.log('error', self.name + ': ' + self.rpm_name +
+                             ' has the wrong size.')
+            os.remove(part_file)
+            return False
+        if self.digest and self.digest != 'sha256:' + self.checksum:
+            self.repolog.log('error', self.name + ': ' + self.rpm_name +
+                             ' failed checksum.')
+            os.remove(part_file)
+            return False
+
+        # Packages still to be verified stay out of the repository
+        if not self.verifier:
+            os.replace(part_file, self.filename)
+        self.repolog.log('debug', self.name + ': ' + self.rpm_name +
+                         ' sha256 ' + self.checksum)
+        return True
+
+    def download_stream(self, part_file):
+        for attempt in range(DOWNLOAD_RETRIES):
+            # Hash whatever an earlier attempt already saved
+            sha256 = hashlib.sha256()
+            offset = 0
+            if os.path.isfile(part_file):
+                with open(part_file, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        sha256.update(chunk)
+                        offset += len(chunk)
+
+            # Partial file was finished but never renamed; its length alone
+            # does not prove that, so it must also match the digest
+            if offset and offset == self.size:
+                if self.digest == 'sha256:' + sha256.hexdigest():
+                    return sha256
+                self.repolog.log('debug', self.name + ': cannot verify ' +
+                                 'the saved download, starting over.')
+                os.remove(part_file)
+                sha256 = hashlib.sha256()
+                offset = 0
+
+            # Only ask for the bytes that are still missing
+            request = urllib.request.Request(self.download_url)
+            if offset:
+                request.add_header('Range', 'bytes=' + str(offset) + '-')
+                self.repolog.log('info', self.name +
+                                 ': resuming download at ' + str(offset) +
+                                 ' bytes.')
+
+            try:
+                response = urllib.request.urlopen(request,
+                                                  timeout=DOWNLOAD_TIMEOUT)
+            except HTTPError as e:
+                if e.code == 416:
+                    # Partial file does not belong to this asset
+                    os.remove(part_file)
+                    continue
+                self.repolog.log('error', 'Could not download release.')
+                self.repolog.log('error', e.code)
+                return None
+            except URLError as e:
+                # A stalled connect is retried like a stalled transfer
+                if isinstance(e.reason, socket.timeout):
+                    self.repolog.log('warning', self.name +
+                                     ': download timed out.')
+                    continue
+                self.repolog.log('error', 'Could not download release.')
+                self.repolog.log('error', e.reason)
+                return None
+            except socket.timeout:
+                self.repolog.log('warning', self.name +
+                                 ': download timed out.')
+                continue
+
+            # Server ignored the range so the body starts from zero
+            if offset and response.status != 206:
+                sha256 = hashlib.sha256()
+                offset = 0
+
+            # Save and checksum the RPM in a single pass
+            received = offset
+            try:
+                with open(part_file, 'ab' if offset else 'wb') as f:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        received += len(chunk)
+                        self.transferred += len(chunk)
+                        if self.scheduler:
+                            self.scheduler.throttle(len(chunk))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except (IOError, OSError, http.client.HTTPException) as e:
+                self.repolog.log('warning', self.name +
+                                 ': download interrupted: ' + str(e))
+                continue
+
+            # A connection closed early ends the body without an error, so
+            # resume from what was saved instead of checking a short file
+            length = response.headers.get('Content-Length', '')
+            expected = self.size or \
+                (offset + int(length) if length.isdigit() else None)
+            if expected and received < expected:
+                self.repolog.log('warning', self.name +
+                                 ': download interrupted at ' +
+                                 str(received) + ' of ' + str(expected) +
+                                 ' bytes.')
+                continue
+
+            return sha256
+
+        return None
+
+    def download_segments(self, part_file):
+        # Split the asset into one byte range per connection
+        step = -(-self.size // self.segments)
+        ranges = [(start, min(start + step, self.size) - 1)
+                  for start in range(0, self.size, step)]
+        self.repolog.log('info', self.name + ': downloading in ' +
+                         str(len(ranges)) + ' segments.')
+
+        # Preallocate so each segment can write at its own offset; the
+        # file only becomes the partial download once it has no holes
+        segments_file = self.filename + '.segments'
         try:
-            with open(self.filename, 'wb') as f:
-                shutil.copyfileobj(response, f)
-        except IOError as e:
-            print(self.name + ': could not save ' + self.rpm_name + '.')
+            with open(segments_file, 'wb') as f:
+                f.truncate(self.size)
+            fd = os.open(segments_file, os.O_WRONLY)
+        except (IOError, OSError) as e:
             self.repolog.log('error', e)
+            return None
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                results = list(executor.map(
+                    lambda r: self.download_segment(fd, r[0], r[1]), ranges))
+        finally:
+            os.close(fd)
+
+        # A file with holes must not be resumed as a single stream
+        if not all(results):
+            self.repolog.log('warning', self.name +
+                             ': segmented download failed, using one stream.')
+            os.remove(segments_file)
+            return None
+
+        self.transferred = self.size
+
+        # Segments finish out of order so hash the assembled file
+        sha256 = hashlib.sha256()
+        with open(segments_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        os.replace(segments_file, part_file)
+
+        return sha256
+
+    def download_segment(self, fd, start, end):
+        offset = start
+
+        for attempt in range(DOWNLOAD_RETRIES):
+            request = urllib.request.Request(self.download_url)
+            request.add_header('Range',
+                               'bytes=' + str(offset) + '-' + str(end))
+
+            try:
+                response = urllib.request.urlopen(request,
+                                                  timeout=DOWNLOAD_TIMEOUT)
+            except (HTTPError, URLError, socket.timeout) as e:
+                self.repolog.log('debug', self.name + ': segment ' +
+                                 str(start) + ' failed: ' + str(e))
+                continue
+
+            # Without range support every segment would get the whole file
+            if response.status != 206:
+                return False
+
+            try:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+                    if self.scheduler:
+                        self.scheduler.throttle(len(chunk))
+            except (OSError, http.client.HTTPException) as e:
+                self.repolog.log('debug', self.name + ': segment ' +
+                                 str(start) + ' interrupted: ' + str(e))
+                continue
+
+            # Closed early; the next attempt asks for the rest of the range
+            if offset != end + 1:
+                self.repolog.log('debug', self.name + ': segment ' +
+                                 str(start) + ' ended at ' + str(offset) +
+                                 '.')
+                continue
+
+            return True
+
+        return False
+
+
+class rpmindex:
+
+    def __init__(self, repo_dir, repolog):
+        self.repo_dir = repo_dir
+        self.repolog = repolog
+        self.index_file = os.path.join(repo_dir, RPM_INDEX_NAME)
+        self.lock = threading.Lock()
+        self.packages = {}
+
+        try:
+            with open(self.index_file) as f:
+                self.packages = json.load(f)
+        except (IOError, ValueError) as e:
+            self.repolog.log('debug', 'RPM index not loaded: ' + str(e))
+
+    def read(self, filename, checksum=None):
+        # Header fields plus the file checksum release assets publish
+        path = os.path.join(self.repo_dir, filename)
+        st = os.stat(path)
+        package = read_rpm_header(path)
+        package.update(size=st.st_size, mtime=st.st_mtime_ns,
+                       sha256=checksum or sha256_file(path))
+        return package
+
+    def refresh(self):
+        # Only packages that are new or changed since the last run are read
+        with self.lock:
+            cached = dict(self.packages)
+        packages = {}
+        read = 0
+        if os.path.isdir(self.repo_dir):
+            for entry in os.scandir(self.repo_dir):
+                if not entry.name.endswith('.rpm') or \
+                        not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat()
+                package = cached.get(entry.name)
+                if package and package['size'] == st.st_size and \
+                        package['mtime'] == st.st_mtime_ns:
+                    packages[entry.name] = package
+                    continue
+                try:
+                    packages[entry.name] = self.read(entry.name)
+                    read += 1
+                except (OSError, ValueError) as e:
+                    self.repolog.log('warning', 'Could not index ' +
+                                     entry.name + ': ' + str(e))
+
+        with self.lock:
+            self.packages = packages
+        self.repolog.log('debug', self.repo_dir + ': indexed ' +
+                         str(len(packages)) + ' packages, read ' + str(read) +
+                         ' headers.')
+        return packages
+
+    def add(self, filename, checksum=None):
+        try:
+            package = self.read(filename, checksum)
+        except (OSError, ValueError) as e:
+            self.repolog.log('warning', 'Could not index ' + filename + ': ' +
+                             str(e))
+            return None
+        with self.lock:
+            self.packages[filename] = package
+        return package
+
+    def find(self, checksum):
+        # A renamed asset still matches the package already in the repo
+        with self.lock:
+            for filename, package in self.packages.items():
+                if package['sha256'] == checksum:
+                    return filename
+        return None
+
+    def get(self, filename):
+        with self.lock:
+            return self.packages.get(filename)
+
+    def save(self):
+        tmp_file = self.index_file + '.tmp'
+        try:
+            with self.lock:
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.packages, f, sort_keys=True)
+            os.replace(tmp_file, self.index_file)
+        except (IOError, OSError) as e:
+            self.repolog.log('error', 'Could not save RPM index: ' + str(e))
+
+
+class rpmverifier:
+
+    def __init__(self, quarantine_dir, workers, require_signature, repolog):
+        self.quarantine_dir = quarantine_dir
+        self.require_signature = require_signature
+        self.repolog = repolog
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def quarantined(self, rpm_name):
+        return os.path.isfile(os.path.join(self.quarantine_dir, rpm_name))
+
+    def submit(self, name, path, checksum=None, target=None):
+        # path is checked where it is and only then renamed to target
+        future = self.executor.submit(verify_package, path, checksum,
+                                      self.require_signature)
+        with self.lock:
+            self.pending.append((name, path, target or path, future))
+
+    def wait(self):
+        # Nothing reaches createrepo until every package has been checked
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        verified = []
+        for name, path, target, future in pending:
+            try:
+                ok, message = future.result()
+            except Exception as e:
+                ok, message = False, str(e)
+            if not ok:
+                self.quarantine(name, path, message, target)
+                continue
+            try:
+                os.replace(path, target)
+            except OSError as e:
+                self.repolog.log('error', name + ': could not publish ' +
+                                 os.path.basename(target) + ': ' + str(e))
+                continue
+            self.repolog.log('info', name + ': verified ' +
+                             os.path.basename(target) + '.')
+            self.repolog.log('debug', message)
+            verified.append((name, target))
+
+        return verified
+
+    def quarantine(self, name, path, reason, target=None):
+        target = target or path
+        self.repolog.log('error', name + ': ' + os.path.basename(target) +
+                         ' failed verification: ' + reason)
+        try:
+            os.makedirs(self.quarantine_dir, exist_ok=True)
+            os.replace(path, os.path.join(self.quarantine_dir,
+                                          os.path.basename(target)))
+        except OSError as e:
+            # Never leave a package that failed in the repository
+            self.repolog.log('error', 'Could not quarantine ' + path + ': ' +
+                             str(e))
+            os.remove(path)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class packagestore:
+
+    def __init__(self, store_dir, repolog):
+        self.store_dir = store_dir
+        self.repolog = repolog
+
+    def blob_path(self, checksum):
+        return os.path.join(self.store_dir, checksum[:2], checksum)
+
+    def hash_file(self, path):
+        return sha256_file(path)
+
+    def add(self, path, checksum=None):
+        # Turn path into a hardlink of the blob holding the same content
+        if checksum is None:
+            checksum = self.hash_file(path)
+        blob = self.blob_path(checksum)
+
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                if not os.path.samefile(path, blob):
+                    self.replace_with_link(blob, path)
+        except OSError as e:
+            self.repolog.log('error', 'Could not store ' + path + ': ' +
+                             str(e))
+            return None
+
+        return checksum
+
+    def link(self, checksum, dest):
+        # Adding a stored package to a repository costs a single link
+        blob = self.blob_path(checksum)
+        if not os.path.isfile(blob):
+            return False
+
+        try:
+            self.replace_with_link(blob, dest)
+        except OSError as e:
+            self.repolog.log('error', 'Could not link ' + dest + ': ' + str(e))
             return False
 
-        print(self.name + ': updated to latest release.')
         return True
 
+    def replace_with_link(self, blob, dest):
+        tmp_file = dest + '.link'
+        if os.path.lexists(tmp_file):
+            os.remove(tmp_file)
+        os.link(blob, tmp_file)
+        os.replace(tmp_file, dest)
+
+    def dedupe(self, repo_dir):
+        # Packages with a single link have not been added to the store yet
+        added = 0
+        for root, dirs, files in os.walk(repo_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.rpm') and os.lstat(path).st_nlink == 1:
+                    if self.add(path):
+                        added += 1
+
+        self.repolog.log('info', repo_dir + ': added ' + str(added) +
+                         ' packages to the store.')
+        return added
+
+    def gc(self):
+        # Blobs nothing links to any more only hold their own link
+        removed = 0
+        freed = 0
+        for root, dirs, files in os.walk(self.store_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if st.st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+                    freed += st.st_size
+
+        self.repolog.log('info', 'Store: removed ' + str(removed) +
+                         ' unreferenced packages (' +
+                         str(freed // (1024 * 1024)) + ' MiB).')
+        return removed
+
+
+class mirrorprober:
+
+    def __init__(self, cache_file, ttl, repolog):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.repolog = repolog
+        self.lock = threading.Lock()
+        self.rankings = {}
+
+        # Rankings younger than the TTL are used without probing again
+        try:
+            with open(self.cache_file) as f:
+                self.rankings = json.load(f)
+        except (IOError, ValueError) as e:
+            self.repolog.log('debug', 'Mirror cache not loaded: ' + str(e))
+
+    def probe(self, url, variables):
+        # Latency is the time to the response headers, throughput the rest
+        sample = url
+        for key, value in variables.items():
+            sample = sample.replace('$' + key, value)
+        sample = sample.rstrip('/') + '/' + MIRROR_SAMPLE
+
+        result = {'url': url, 'ok': False, 'latency': None,
+                  'throughput': None, 'score': float('inf')}
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(sample,
+                                        timeout=MIRROR_TIMEOUT) as response:
+                latency = time.monotonic() - start
+                size = len(response.read())
+        except (HTTPError, URLError, OSError) as e:
+            self.repolog.log('debug', url + ': probe failed: ' + str(e))
+            return result
+        elapsed = time.monotonic() - start
+
+        throughput = max(size, 1) / max(elapsed - latency, 0.001)
+        result.update(ok=True, latency=round(latency, 4),
+                      throughput=round(throughput),
+                      score=round(latency + MIRROR_SCORE_SIZE / throughput,
+                                  4))
+        return result
+
+    def rank(self, groups, variables):
+        # groups maps a cache key to the mirrors to choose between
+        now = time.time()
+        with self.lock:
+            stale = {key: urls for key, urls in groups.items()
+                     if now - self.rankings.get(key, {}).get('checked', 0) >
+                     self.ttl or
+                     sorted(self.rankings[key]['urls']) != sorted(urls)}
+
+        # Every mirror of every repository is probed at once
+        if stale:
+            probes = sorted(set(url for urls in stale.values()
+                                for url in urls))
+            with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+                results = dict(zip(probes, executor.map(
+                    lambda url: self.probe(url, variables), probes)))
+
+            with self.lock:
+                for key, urls in stale.items():
+                    ranked = sorted((results[url] for url in urls),
+                                    key=lambda result: result['score'])
+                    self.rankings[key] = {
+                        'checked': now,
+                        'urls': [result['url'] for result in ranked],
+                        'probes': [dict(result, score=None)
+                                   if not result['ok'] else result
+                                   for result in ranked],
+                    }
+                    for result in ranked:
+                        if not result['ok']:
+                            continue
+                        self.repolog.log('debug', key + ': ' +
+                                         result['url'] + ' latency ' +
+                                         str(result['latency']) +
+                                         's, throughput ' +
+                                         str(result['throughput']) + ' B/s.')
+                    self.repolog.log('info', key + ': fastest mirror is ' +
+                                     ranked[0]['url'] + '.')
+            self.save()
+
+        with self.lock:
+            return {key: list(self.rankings[key]['urls']) for key in groups}
+
+    def save(self):
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with self.lock:
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.rankings, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            self.repolog.log('error', 'Could not save mirror cache: ' +
+                             str(e))
+            return False
+
+        return True
+
+
+class reposnapshot:
+
+    def __init__(self, name, repo_dir, keep, repolog):
+        self.name = name
+        self.repo_dir = repo_dir
+        self.keep = keep
+        self.repolog = repolog
+        self.snapshot_dir = os.path.join(repo_dir, REPO_SNAPSHOTS)
+        self.current = os.path.join(repo_dir, REPO_CURRENT)
+        self.pending = None
+
+    def create(self):
+        # A new snapshot starts as hardlinks of the published one, or of
+        # the repository synced in place before snapshots were used
+        source = self.current if os.path.isdir(self.current) else \
+            self.repo_dir
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        self.pending = os.path.join(self.snapshot_dir, stamp + '.partial')
+        if os.path.lexists(self.pending):
+            shutil.rmtree(self.pending)
+
+        linked, copied = self.link_tree(os.path.realpath(source),
+                                        self.pending)
+        self.repolog.log('info', self.name + ': created snapshot ' + stamp +
+                         ' (' + str(linked) + ' packages linked, ' +
+                         str(copied) + ' files copied).')
+        return self.pending
+
+    def link_tree(self, source, dest):
+        linked = 0
+        copied = 0
+        for root, dirs, files in os.walk(source):
+            if root == source:
+                dirs[:] = [name for name in dirs
+                           if name not in (REPO_SNAPSHOTS, REPO_CURRENT)]
+                files = [name for name in files if name != REPO_CURRENT]
+            target = os.path.join(dest, os.path.relpath(root, source))
+            os.makedirs(target, exist_ok=True)
+
+            # Only packages share their inode; reposync rewrites metadata
+            # and comps.xml in place, which would change the published
+            # snapshot through a hardlink
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                elif name in files and name.endswith('.rpm'):
+                    os.link(path, os.path.join(target, name))
+                    linked += 1
+                elif name in files:
+                    shutil.copy2(path, os.path.join(target, name))
+                    copied += 1
+
+        return linked, copied
+
+    def publish(self):
+        # Clients see either the old snapshot or the new one, never a mix
+        snapshot = self.pending[:-len('.partial')]
+        os.rename(self.pending, snapshot)
+        self.pending = None
+
+        tmp_link = self.current + '.tmp'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(snapshot, self.repo_dir), tmp_link)
+        os.replace(tmp_link, self.current)
+
+        self.repolog.log('info', self.name + ': published snapshot ' +
+                         os.path.basename(snapshot) + '.')
+
+    def discard(self):
+        if self.pending:
+            shutil.rmtree(self.pending, ignore_errors=True)
+            self.repolog.log('warning', self.name + ': discarded snapshot ' +
+                             os.path.basename(self.pending) + '.')
+            self.pending = None
+
+    def prune(self):
+        # Keep the newest snapshots; partial ones are left from failed runs
+        current = os.path.realpath(self.current)
+        names = sorted(os.listdir(self.snapshot_dir))
+        published = [name for name in names if not name.endswith('.partial')]
+        remove = [name for name in names if name.endswith('.partial')]
+        if self.keep > 0:
+            remove += published[:-self.keep]
+
+        removed = 0
+        for name in remove:
+            path = os.path.join(self.snapshot_dir, name)
+            if path == self.pending or os.path.realpath(path) == current:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+
+        self.repolog.log('info', self.name + ': ' + str(removed) +
+                         ' old snapshots removed.')
+        return removed
+
 
 class reposyncer:
 
-    def __init__(self, os, version, repolog):
+    def __init__(self, os, version, repolog, scheduler=None, prober=None,
+                 snapshot=None):
         self.repo_name = os + ' ' + version
         self.os = os.lower()
         self.version = version
         self.repolog = repolog
+        self.scheduler = scheduler
+        self.prober = prober
+        self.snapshot = snapshot
+        self.priority = PRIORITIES.get(self.repo_name, PRIORITY_SYNC)
+
+    def reposync(self, timeout=None, stop=None):
+        with self.repolog.span('reposync', self.repo_name) as span:
+            if self.scheduler:
+                with self.scheduler.transfer(self.priority):
+                    synced = self.run_reposync(timeout, stop)
+            else:
+                synced = self.run_reposync(timeout, stop)
+            span.update(ok=synced, returncode=self.returncode)
+
+        # A failed sync never gets published
+        if not synced and self.snapshot:
+            self.snapshot.discard()
 
-    def reposync(self):
+        return synced
+
+    def run_reposync(self, timeout, stop=None):
         # Build reposync command
-        self.conf = os.path.join('/etc/reposyncer.d/',
+        self.conf = os.path.join(REPOSYNC_CONF_DIR,
                                  self.os + '_' + self.version)
-        self.repo = os.path.join('/srv/repos/', self.os, self.version)
+        self.repo = os.path.join(REPO_ROOT_DIR, self.os, self.version)
+        self.returncode = None
+        self.duration = 0
+
+        # Sync into a new snapshot instead of the published tree
+        if self.snapshot:
+            try:
+                self.repo = self.snapshot.create()
+            except OSError as e:
+                self.repolog.log('error', self.repo_name +
+                                 ': could not create snapshot: ' + str(e))
+                return False
+
+        # reposync cannot share the token bucket, so cap it at a fair share
+        limit = self.scheduler.share() if self.scheduler else None
+        conf = self.generated_conf(limit)
 
         reposync_command = [
             'reposync',
-            '-c',  + self.conf,
-            '-p',  + self.repo,
+            '-c', conf,
+            '-p', self.repo,
             '--gpgcheck',
             '--delete',
             '--downloadcomps',
             '--download-metadata',
-            '--quiet',
         ]
 
         # Run the reposync process
+        start = time.monotonic()
         try:
-            subprocess.call(reposync_command,
-                            stdout=open(os.devnull, 'wb'),
-                            stderr=open(os.devnull, 'wb'))
+            progress = commandprogress('reposync', self.repo_name,
+                                       self.repolog)
+            self.returncode = run_command(reposync_command, progress, timeout,
+                                          stop)
+        except subprocess.TimeoutExpired:
+            if stop is not None and stop.is_set():
+                self.repolog.log('warning', self.repo_name +
+                                 ': sync stopped.')
+            else:
+                self.repolog.log('error', self.repo_name +
+                                 ': timed out syncing repository.')
+            return False
         except OSError as e:
-            print(self.repo_name + ': error syncing repository.')
+            self.repolog.log('error', self.repo_name +
+                             ': error syncing repository.')
             self.repolog.log('error', e)
             return False
+        finally:
+            self.duration = time.monotonic() - start
+            if conf != self.conf:
+                os.remove(conf)
+
+        if self.returncode != 0:
+            self.repolog.log('error', self.repo_name +
+                             ': reposync exited with status ' +
+                             str(self.returncode) + '.')
+            return False
 
-        print(self.repo_name + ': successfully synced repository.')
+        self.repolog.log('info', self.repo_name +
+                         ': successfully synced repository.')
         return True
 
+    def generated_conf(self, limit):
+        # The yum config is used as is unless it needs a limit or mirrors
+        if not limit and not self.prober:
+            return self.conf
+
+        config = configparser.RawConfigParser(strict=False)
+        try:
+            if not config.read(self.conf):
+                return self.conf
+        except configparser.Error as e:
+            self.repolog.log('warning', self.repo_name +
+                             ': using config as is, cannot parse it: ' +
+                             str(e))
+            return self.conf
+
+        # Bandwidth limit for every repository
+        changed = False
+        if limit:
+            if not config.has_section('main'):
+                config.add_section('main')
+            config.set('main', 'throttle', str(limit))
+            changed = True
+
+        # yum tries the mirrors of a baseurl in order, fastest first
+        if self.prober:
+            groups = {}
+            for section in config.sections():
+                urls = config.get(section, 'baseurl', fallback='').split()
+                if len(urls) > 1:
+                    groups[self.repo_name + ' ' + section] = (section, urls)
+            variables = {'releasever': self.version,
+                         'basearch': os.uname().machine,
+                         'arch': os.uname().machine}
+            rankings = self.prober.rank(
+                {key: urls for key, (section, urls) in groups.items()},
+                variables)
+            for key, (section, urls) in groups.items():
+                config.set(section, 'baseurl', '\n'.join(rankings[key]))
+                config.set(section, 'failovermethod', 'priority')
+                changed = True
+
+        if not changed:
+            return self.conf
+
+        fd, path = tempfile.mkstemp(prefix=self.os + '_' + self.version + '.',
+                                    suffix='.conf')
+        with os.fdopen(fd, 'w') as f:
+            config.write(f)
+
+        return path
+
 
 class repocreator:
 
@@ -153,31 +1630,181 @@ class repocreator:
         self.name = name
         self.colo_dir = repo_dir
         self.repolog = repolog
+        self.manifest_file = os.path.join(repo_dir, MANIFEST_NAME)
 
-    def createrepo(self):
+    def build_manifest(self):
+        # Name, size and mtime of every package createrepo would index
+        manifest = {}
+        for root, dirs, files in os.walk(self.colo_dir):
+            for name in files:
+                if not name.endswith('.rpm'):
+                    continue
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                manifest[os.path.relpath(path, self.colo_dir)] = \
+                    [st.st_size, st.st_mtime_ns]
+
+        return manifest
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save_manifest(self, manifest):
+        tmp_file = self.manifest_file + '.tmp'
         try:
-            subprocess.call(['createrepo', self.colo_dir],
-                            stdout=open(os.devnull, 'wb'),
-                            stderr=open(os.devnull, 'wb'))
+            with open(tmp_file, 'w') as f:
+                json.dump(manifest, f, sort_keys=True)
+            os.replace(tmp_file, self.manifest_file)
+        except (IOError, OSError) as e:
+            self.repolog.log('error', 'Could not save manifest: ' + str(e))
+
+    def createrepo(self, force=False):
+        with self.repolog.span('createrepo', self.name) as span:
+            created = self.run_createrepo(force)
+            span['ok'] = created
+
+        return created
+
+    def run_createrepo(self, force):
+        # Skip repositories whose packages have not changed
+        manifest = self.build_manifest()
+        repomd = os.path.join(self.colo_dir, 'repodata', 'repomd.xml')
+        has_metadata = os.path.isfile(repomd)
+        if not force and has_metadata and manifest == self.load_manifest():
+            self.repolog.log('info', self.name + ': repository unchanged.')
+            return True
+
+        # Only re-read packages that are new or modified
+        createrepo_command = ['createrepo', '--verbose',
+                              '--cachedir', CREATEREPO_CACHE_DIR]
+        if has_metadata:
+            createrepo_command.append('--update')
+        createrepo_command.append(self.colo_dir)
+
+        try:
+            progress = commandprogress('createrepo', self.name, self.repolog)
+            returncode = run_command(createrepo_command, progress)
         except OSError as e:
-            print(self.name + ': error creating repository.')
+            self.repolog.log('error', self.name +
+                             ': error creating repository.')
             self.repolog.log('error', e)
             return False
 
-        print(self.name + ': successfully created repository.')
+        if returncode != 0:
+            self.repolog.log('error', self.name +
+                             ': createrepo exited with status ' +
+                             str(returncode) + '.')
+            return False
+
+        self.save_manifest(manifest)
+        self.repolog.log('info', self.name +
+                         ': successfully created repository.')
         return True
 
 
+class repopruner:
+
+    def __init__(self, name, repo_dir, keep, repolog, index=None):
+        self.name = name
+        self.repo_dir = repo_dir
+        self.keep = keep
+        self.repolog = repolog
+        self.index = index
+
+    def superseded(self):
+        # Headers give the real epoch; filenames are only a fallback
+        if self.index:
+            packages = self.index.refresh()
+        else:
+            packages = {}
+            for filename in os.listdir(self.repo_dir):
+                nevra = parse_rpm_filename(filename)
+                if nevra is not None:
+                    nevra['mtime'] = os.stat(
+                        os.path.join(self.repo_dir, filename)).st_mtime_ns
+                    packages[filename] = nevra
+
+        # Group every package by name and arch
+        groups = {}
+        for filename, nevra in packages.items():
+            key = (nevra['name'], nevra['arch'])
+            evr = (nevra['epoch'], nevra['version'], nevra['release'])
+            groups.setdefault(key, []).append((evr, nevra['mtime'],
+                                               filename))
+
+        # Everything older than the newest releases can go, as can older
+        # copies of a release, such as an asset that was renamed
+        old = []
+        for key, builds in sorted(groups.items()):
+            builds.sort(key=lambda build: build[1], reverse=True)
+            builds.sort(key=functools.cmp_to_key(
+                lambda x, y: label_compare(x[0], y[0])), reverse=True)
+            kept = []
+            for evr, mtime, filename in builds:
+                if len(kept) < self.keep and evr not in kept:
+                    kept.append(evr)
+                else:
+                    old.append(filename)
+
+        return sorted(old)
+
+    def prune(self, dry_run=False):
+        if self.keep < 1 or not os.path.isdir(self.repo_dir):
+            return []
+
+        old = self.superseded()
+        for filename in old:
+            if dry_run:
+                self.repolog.log('info', self.name + ': would remove ' +
+                                 filename + '.')
+                continue
+            try:
+                os.remove(os.path.join(self.repo_dir, filename))
+            except OSError as e:
+                self.repolog.log('error', 'Could not remove ' + filename +
+                                 ': ' + str(e))
+                continue
+            self.repolog.log('info', self.name + ': removed ' + filename + '.')
+
+        self.repolog.log('info', self.name + ': ' + str(len(old)) +
+                         ' superseded packages' +
+                         (' found.' if dry_run else ' pruned.'))
+        return old
+
+
+class jsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        # One JSON object per line, with span fields at the top level
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'span', {}))
+        return json.dumps(entry, sort_keys=True)
+
+
 class myLogger:
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, json_file=None, prom_file=None,
+                 status_file=None):
         # Logging settings
         self.logger = logging.getLogger('reposyncer')
         if not debug:
-            log_level = 0
+            log_level = 20
         else:
             log_level = 10
-        self.logger.setLevel(log_level)
+        self.logger.setLevel(10 if json_file else log_level)
+        self.prom_file = prom_file
+        self.status_file = status_file
+        self.spans = {}
+        self.status = {}
+        self.lock = threading.Lock()
 
         # Logging formats
         _log_format = '[%(asctime)s] [%(levelname)8s] %(message)s'
@@ -187,47 +1814,561 @@ class myLogger:
         ch = logging.StreamHandler(sys.stdout)
         ch.setLevel(log_level)
         ch.setFormatter(log_format)
-        self.logger.addHandler(ch)
+        handlers = [ch]
+
+        # Adds a JSON lines handler that also receives every span
+        if json_file:
+            jh = logging.FileHandler(json_file)
+            jh.setLevel(10)
+            jh.setFormatter(jsonFormatter())
+            handlers.append(jh)
+
+        # Workers only enqueue records; a listener thread writes them out
+        log_queue = queue.Queue()
+        self.logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self.listener = logging.handlers.QueueListener(
+            log_queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+        # The listener thread is a daemon, so flush it even when an
+        # uncaught exception ends the run before close()
+        atexit.register(self.close)
 
     def log(self, lvl, msg):
         level = logging.getLevelName(lvl.upper())
         self.logger.log(level, msg)
 
+    @contextlib.contextmanager
+    def span(self, stage, name, **fields):
+        # Time one stage of one project or repository
+        span = dict(fields, stage=stage, name=name)
+        start = time.monotonic()
+        try:
+            yield span
+        except Exception:
+            span['ok'] = False
+            raise
+        finally:
+            span['duration'] = round(time.monotonic() - start, 3)
+            with self.lock:
+                self.spans[(stage, name)] = span
+            self.logger.debug(name + ': ' + stage + ' took ' +
+                              str(span['duration']) + 's.',
+                              extra={'span': span})
+
+    def progress(self, stage, name, stats):
+        # Latest progress of each running command
+        with self.lock:
+            self.status.setdefault(stage, {})[name] = stats
+            status = {'updated': int(time.time()),
+                      'jobs': json.loads(json.dumps(self.status))}
 
-if __name__ == '__main__':
-    def _rpm2repo():
-        # Handle individual RPM updates
-        colo_dir = os.path.join(REPO_ROOT_DIR, REPO_COLO)
+        if not self.status_file:
+            return
+
+        tmp_file = self.status_file + '.' + str(threading.get_ident())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(status, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.status_file)
+        except (IOError, OSError) as e:
+            self.log('error', 'Could not write status: ' + str(e))
+
+    def label(self, value):
+        return value.replace('\\', '\\\\').replace('"', '\\"')
+
+    def write_prometheus(self):
+        # Format for the node_exporter textfile collector
+        metrics = [
+            ('duration', 'reposyncer_stage_duration_seconds',
+             'Seconds the last run of each stage took.'),
+            ('bytes', 'reposyncer_stage_bytes',
+             'Bytes transferred by the last run of each stage.'),
+            ('ok', 'reposyncer_stage_success',
+             'Whether the last run of each stage succeeded.'),
+        ]
+        with self.lock:
+            spans = sorted(self.spans.values(),
+                           key=lambda span: (span['stage'], span['name']))
+            status = [(stage, name, stats)
+                      for stage, jobs in sorted(self.status.items())
+                      for name, stats in sorted(jobs.items())]
+
+        lines = []
+        for field, metric, description in metrics:
+            lines.append('# HELP ' + metric + ' ' + description)
+            lines.append('# TYPE ' + metric + ' gauge')
+            for span in spans:
+                if span.get(field) is None:
+                    continue
+                labels = 'stage="' + span['stage'] + '",name="' + \
+                    self.label(span['name']) + '"'
+                lines.append(metric + '{' + labels + '} ' +
+                             str(float(span[field])))
+        progress = [
+            ('packages', 'reposyncer_progress_packages',
+             'Packages processed by the latest run of each command.'),
+            ('bytes', 'reposyncer_progress_bytes',
+             'Bytes downloaded by the latest run of each command.'),
+        ]
+        for field, metric, description in progress:
+            lines.append('# HELP ' + metric + ' ' + description)
+            lines.append('# TYPE ' + metric + ' gauge')
+            for stage, name, stats in status:
+                lines.append(metric + '{stage="' + stage + '",name="' +
+                             self.label(name) + '"} ' + str(stats[field]))
+
+        lines.append('# HELP reposyncer_last_run_timestamp_seconds '
+                     'When reposyncer last finished.')
+        lines.append('# TYPE reposyncer_last_run_timestamp_seconds gauge')
+        lines.append('reposyncer_last_run_timestamp_seconds ' +
+                     str(int(time.time())))
+
+        # The collector may read at any time, so never leave a partial file
+        tmp_file = self.prom_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_file, self.prom_file)
+        except (IOError, OSError) as e:
+            self.log('error', 'Could not write metrics: ' + str(e))
+
+    def close(self):
+        atexit.unregister(self.close)
+        if self.prom_file:
+            self.write_prometheus()
+        self.listener.stop()
+
+
+def _rpm2repo(args, repolog, store=None, scheduler=None, verifier=None):
+    # Handle individual RPM updates
+    colo_dir = os.path.join(REPO_ROOT_DIR, REPO_COLO)
+    cache = feedcache(args.feed_cache, repolog)
+    index = rpmindex(colo_dir, repolog)
+    index.refresh()
+
+    for name, repo in PROJECTS.items():
+        PACKAGES[name] = rpm2repo(name, repo[0], repo[1], colo_dir, repolog,
+                                  cache, args.segments, store, scheduler,
+                                  verifier, index)
+
+    # Discover every release in one query when a token is available
+    batched = {}
+    token = os.environ.get('GITHUB_TOKEN')
+    if token and not args.no_batch:
+        batched = releasebatch(PROJECTS, token, repolog).get_assets()
+
+    # Fetch release feeds and RPMs in parallel
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(
+            lambda package: package.get_latest_release(
+                batched.get(package.name)),
+            PACKAGES.values()))
+
+    cache.save()
+
+    if verifier:
+        _verify(verifier, repolog, store)
+
+    # Drop old releases before they reach the metadata
+    rp = repopruner('Colo', colo_dir, args.keep, repolog, index)
+    rp.prune(args.dry_run)
+    index.refresh()
+    index.save()
+
+    cr = repocreator('Colo', colo_dir, repolog)
+    return cr.createrepo(args.force)
+
+
+def _verify(verifier, repolog, store=None):
+    # Only packages that passed are shared through the store
+    with repolog.span('verify', 'Colo') as span:
+        verified = verifier.wait()
+        span['packages'] = len(verified)
+    for name, path in verified:
+        package = PACKAGES[name]
+        if package.index:
+            package.index.add(os.path.basename(path), package.checksum)
+        if store:
+            store.add(path, package.checksum)
+
+
+def _reposyncer(args, repolog, store=None, scheduler=None, prober=None,
+                stop=None):
+    # Sync all configured repositories
+    for name, version in REPOSITORIES.items():
+        if args.snapshots:
+            repo_dir = os.path.join(REPO_ROOT_DIR, name.lower(), version)
+            SNAPSHOTS[name + ' ' + version] = reposnapshot(
+                name + ' ' + version, repo_dir, args.keep_snapshots, repolog)
+    syncers = [reposyncer(name, version, repolog, scheduler, prober,
+                          SNAPSHOTS.get(name + ' ' + version))
+               for name, version in REPOSITORIES.items()]
 
+    # Repositories share no state so they can all sync at once
+    with ThreadPoolExecutor(max_workers=args.sync_workers) as executor:
+        results = list(executor.map(
+            lambda syncer: syncer.reposync(args.timeout, stop), syncers))
+
+    # Replace duplicate packages with links into the store
+    if store:
+        for syncer, result in zip(syncers, results):
+            if result:
+                store.dedupe(syncer.repo)
+
+    # Record what changed upstream in the metadata reposync downloaded
+    if args.index:
+        for syncer, result in zip(syncers, results):
+            if not result or not os.path.isdir(syncer.repo):
+                continue
+            for repoid in sorted(os.listdir(syncer.repo)):
+                repo_dir = os.path.join(syncer.repo, repoid)
+                if os.path.isfile(os.path.join(repo_dir, 'repodata',
+                                               'repomd.xml')):
+                    _index(args, repolog, syncer.repo_name + ' ' + repoid,
+                           repo_dir)
+
+    for syncer in syncers:
+        repolog.log('info', syncer.repo_name + ': exit status ' +
+                    str(syncer.returncode) + ' after ' +
+                    str(round(syncer.duration)) + 's.')
+    repolog.log('info', str(results.count(True)) + ' of ' + str(len(results)) +
+                ' repositories synced.')
+
+    return all(results)
+
+
+def _index(args, repolog, repo, repo_dir):
+    # Index the primary metadata and log how it differs from the last run
+    if repoindex is None:
+        repolog.log('warning', repo + ': repoindex.py not found, '
+                    'not indexing.')
+        return False
+
+    index = None
+    try:
+        with repolog.span('index', repo) as span:
+            index = repoindex.repodataindex(args.index_db)
+            previous = index.latest(repo)
+            checksum = repoindex.find_primary(repo_dir)[1]
+            if previous and checksum and previous['checksum'] == checksum:
+                repolog.log('debug', repo + ': metadata unchanged.')
+                return True
+
+            label = time.strftime('%Y%m%d-%H%M%S')
+            span['packages'] = index.index(repo, label, repo_dir)
+            if previous:
+                changes = index.diff(repo, previous['label'], label)
+                repolog.log('info', repo + ': ' +
+                            str(len(changes['added'])) + ' added, ' +
+                            str(len(changes['removed'])) + ' removed, ' +
+                            str(len(changes['updated'])) +
+                            ' updated since ' + previous['label'] + '.')
+                for package in changes['updated']:
+                    repolog.log('debug', repo + ': ' + package['name'] +
+                                '.' + package['arch'] + ' ' +
+                                ', '.join(package['old']) + ' -> ' +
+                                package['new'])
+            # --keep-snapshots 0 keeps every indexed snapshot as well
+            if args.keep_snapshots:
+                index.prune(repo, max(args.keep_snapshots, 2))
+    except (OSError, ValueError, KeyError, repoindex.ET.ParseError,
+            repoindex.sqlite3.Error) as e:
+        repolog.log('error', repo + ': could not index metadata: ' + str(e))
+        return False
+    finally:
+        if index:
+            index.close()
+
+    return True
+
+
+def _repocreator(args, repolog):
+    # Run createrepo across all repositories
+    created = True
+    for name, version in REPOSITORIES.items():
+        repo_dir = os.path.join(REPO_ROOT_DIR, name.lower(), version)
+        snapshot = SNAPSHOTS.get(name + ' ' + version)
+        if not snapshot:
+            cr = repocreator(name + ' ' + version, repo_dir, repolog)
+            if not cr.createrepo(args.force):
+                created = False
+            elif args.index:
+                _index(args, repolog, name + ' ' + version, repo_dir)
+            continue
+
+        # Metadata is built in the snapshot before it is published
+        if not snapshot.pending:
+            repolog.log('info', name + ' ' + version +
+                        ': no new snapshot to publish.')
+            continue
+        cr = repocreator(name + ' ' + version, snapshot.pending, repolog)
+        if not cr.createrepo(args.force):
+            snapshot.discard()
+            created = False
+            continue
+        try:
+            snapshot.publish()
+            snapshot.prune()
+        except OSError as e:
+            repolog.log('error', name + ' ' + version +
+                        ': could not publish snapshot: ' + str(e))
+            snapshot.discard()
+            created = False
+            continue
+        if args.index:
+            _index(args, repolog, name + ' ' + version, snapshot.current)
+
+    return created
+
+
+class reposyncdaemon:
+
+    def __init__(self, args, repolog, store=None, scheduler=None,
+                 verifier=None, prober=None):
+        self.args = args
+        self.repolog = repolog
+        self.store = store
+        self.scheduler = scheduler
+        self.verifier = verifier
+        self.prober = prober
+        self.colo_dir = os.path.join(REPO_ROOT_DIR, REPO_COLO)
+        self.cache = feedcache(args.feed_cache, repolog)
+        self.index = rpmindex(self.colo_dir, repolog)
+        self.index.refresh()
+        self.stopping = threading.Event()
+
+        # Feeds, validators and poll schedules stay in memory between polls
         for name, repo in PROJECTS.items():
-            PACKAGES[name] = rpm2repo(name, repo[0], repo[1], colo_dir, repolog)
-            PACKAGES[name].get_latest_release()
+            PACKAGES[name] = rpm2repo(name, repo[0], repo[1], self.colo_dir,
+                                      repolog, self.cache, args.segments,
+                                      store, scheduler, verifier, self.index)
+        now = time.monotonic()
+        self.intervals = {name: POLL_INTERVAL for name in PROJECTS}
+        self.next_poll = {name: now for name in PROJECTS}
+        self.next_sync = now
+        self.sync = None
+        self.syncer = ThreadPoolExecutor(max_workers=1)
+        self.wakeup = threading.Event()
+
+    def poll_projects(self, now):
+        due = [name for name, when in self.next_poll.items() if when <= now]
+        if not due:
+            return False
+
+        with ThreadPoolExecutor(max_workers=self.args.workers) as executor:
+            results = list(executor.map(self.poll_project, due))
+        self.cache.save()
 
-        cr = repocreator('Colo', colo_dir, repolog)
-        cr.createrepo()
+        # Poll projects that rarely release less and less often
+        for name, updated in zip(due, results):
+            if updated:
+                self.intervals[name] = POLL_INTERVAL
+            else:
+                self.intervals[name] = min(self.intervals[name] * POLL_BACKOFF,
+                                           MAX_POLL_INTERVAL)
+            self.next_poll[name] = now + self.intervals[name]
+            self.repolog.log('debug', name + ': next poll in ' +
+                             str(round(self.intervals[name])) + 's.')
 
-    def _reposyncer():
-        # Sync all configured repositories
-        pass
+        return any(results)
+
+    def poll_project(self, name):
+        # One bad upstream must not end the daemon; it backs off instead
+        try:
+            return PACKAGES[name].get_latest_release()
+        except Exception as e:
+            self.repolog.log('error', name + ': poll failed: ' +
+                             type(e).__name__ + ': ' + str(e))
+            return False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        self.repolog.log('info', 'Watching ' + str(len(PROJECTS)) +
+                         ' projects and ' + str(len(REPOSITORIES)) +
+                         ' repositories.')
+
+        while not self.stopping.is_set():
+            now = time.monotonic()
+
+            # Only rebuild colo metadata when a new release arrived
+            if self.poll_projects(now):
+                if self.verifier:
+                    _verify(self.verifier, self.repolog, self.store)
+                repopruner('Colo', self.colo_dir, self.args.keep,
+                           self.repolog, self.index).prune(self.args.dry_run)
+                self.index.refresh()
+                self.index.save()
+                repocreator('Colo', self.colo_dir,
+                            self.repolog).createrepo(self.args.force)
+
+            # Syncs run on their own thread so polling stays on schedule;
+            # one still running when the next is due is not doubled up
+            if self.sync is not None and self.sync.done():
+                if self.sync.exception():
+                    self.repolog.log('error', 'Sync failed: ' +
+                                     str(self.sync.exception()))
+                self.sync = None
+            syncing = self.sync is not None
+            if now >= self.next_sync and not syncing:
+                self.sync = self.syncer.submit(self.sync_repositories)
+                self.sync.add_done_callback(lambda future: self.wakeup.set())
+                self.next_sync = now + self.args.sync_interval
+                syncing = True
+
+            if self.repolog.prom_file:
+                self.repolog.write_prometheus()
+
+            # Sleep until the next project or sync is due, or a sync ends
+            wake = min(list(self.next_poll.values()) +
+                       ([] if syncing else [self.next_sync]))
+            self.wakeup.wait(max(1, wake - time.monotonic()))
+            self.wakeup.clear()
+
+        # A running reposync is killed by the stop event; wait for it to
+        # clean up its snapshot
+        self.repolog.log('info', 'Stopping.')
+        self.syncer.shutdown(wait=True)
+
+    def sync_repositories(self):
+        # createrepo skips synced repositories that did not change
+        with self.repolog.span('phase', 'reposync') as span:
+            span['ok'] = _reposyncer(self.args, self.repolog, self.store,
+                                     self.scheduler, self.prober,
+                                     self.stopping)
+        if self.stopping.is_set():
+            return
+        with self.repolog.span('phase', 'createrepo') as span:
+            span['ok'] = _repocreator(self.args, self.repolog)
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
 
-    def _repocreator():
-        # Run createrepo across all repositories
-        pass
 
+def parse_args(argv=None):
     # Set available arguments
     parser = argparse.ArgumentParser(
         description='Wrapper for reposync and createrepo.')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='enables debug messages')
-    args = parser.parse_args()
+    parser.add_argument('-D', '--daemon', action='store_true',
+                        help='keep running and poll for new releases')
+    parser.add_argument('--sync-interval', type=int, default=SYNC_INTERVAL,
+                        help='seconds between reposync runs in daemon mode')
+    parser.add_argument('-w', '--workers', type=int, default=MAX_WORKERS,
+                        help='number of projects to update at once')
+    parser.add_argument('-s', '--segments', type=int, default=1,
+                        help='connections to split large downloads over')
+    parser.add_argument('--sync-workers', type=int, default=SYNC_WORKERS,
+                        help='number of repositories to sync at once')
+    parser.add_argument('-t', '--timeout', type=int, default=REPOSYNC_TIMEOUT,
+                        help='seconds before a reposync run is stopped')
+    parser.add_argument('--max-transfers', type=int, default=MAX_TRANSFERS,
+                        help='downloads and syncs allowed at the same time')
+    parser.add_argument('-b', '--bandwidth', type=int,
+                        help='bytes per second for all transfers (0 for no '
+                        'limit), instead of BANDWIDTH_PROFILES')
+    parser.add_argument('--no-verify', action='store_true',
+                        help='publish release RPMs without checking them')
+    parser.add_argument('--require-signature', action='store_true',
+                        help='quarantine release RPMs that are not signed')
+    parser.add_argument('--verify-workers', type=int, default=VERIFY_WORKERS,
+                        help='number of packages to verify at once')
+    parser.add_argument('--snapshots', action='store_true',
+                        help='sync into snapshots and publish them as ' +
+                        REPO_CURRENT)
+    parser.add_argument('--keep-snapshots', type=int, default=KEEP_SNAPSHOTS,
+                        help='published snapshots to keep (0 keeps all)')
+    parser.add_argument('--index', action='store_true',
+                        help='index repodata and log what changed')
+    parser.add_argument('--index-db', default=INDEX_DB,
+                        help='SQLite file for the repodata index')
+    parser.add_argument('--no-probe', action='store_true',
+                        help='keep the mirror order of each baseurl')
+    parser.add_argument('--mirror-ttl', type=int, default=MIRROR_TTL,
+                        help='seconds before mirrors are probed again')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='run createrepo even if nothing changed')
+    parser.add_argument('--no-batch', action='store_true',
+                        help='query each release feed separately')
+    parser.add_argument('--store', action='store_true',
+                        help='hardlink packages into a shared package store')
+    parser.add_argument('--gc', action='store_true',
+                        help='remove store packages no repository uses')
+    parser.add_argument('-k', '--keep', type=int, default=KEEP_RELEASES,
+                        help='releases of each package to keep (0 keeps all)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only report packages that would be pruned')
+    parser.add_argument('--json-log',
+                        help='also write log records and spans as JSON lines')
+    parser.add_argument('--prom-file',
+                        help='write stage metrics for the textfile collector')
+    parser.add_argument('--status-file',
+                        help='keep live progress of running commands here')
+    parser.add_argument('--feed-cache', default=FEED_CACHE,
+                        help='file to cache release feeds in')
+    parser.add_argument('--mirror-cache', default=MIRROR_CACHE,
+                        help='file to cache mirror rankings in')
 
-    # Configure debugging
-    if args.debug:
-        repolog = myLogger(True)
-    else:
-        repolog = myLogger(False)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Configure debugging and metrics
+    repolog = myLogger(args.debug, args.json_log, args.prom_file,
+                       args.status_file)
+
+    # Share identical packages between repositories
+    store = None
+    if args.store:
+        store = packagestore(os.path.join(REPO_ROOT_DIR, REPO_STORE), repolog)
+
+    # One bandwidth budget and set of slots for every transfer
+    profiles = BANDWIDTH_PROFILES
+    if args.bandwidth is not None:
+        profiles = [(0, 24, args.bandwidth)] if args.bandwidth else []
+    scheduler = transferscheduler(args.max_transfers, profiles, repolog)
+
+    # Check signatures and checksums of release RPMs as they arrive
+    verifier = None
+    if not args.no_verify:
+        verifier = rpmverifier(os.path.join(REPO_ROOT_DIR, REPO_QUARANTINE),
+                               args.verify_workers, args.require_signature,
+                               repolog)
+
+    # Sync from the fastest mirror of each repository
+    prober = None
+    if not args.no_probe:
+        prober = mirrorprober(args.mirror_cache, args.mirror_ttl, repolog)
+
+    # Keep running and poll each project on its own schedule
+    if args.daemon:
+        reposyncdaemon(args, repolog, store, scheduler, verifier,
+                       prober).run()
+        if verifier:
+            verifier.close()
+        repolog.close()
+        sys.exit(0)
 
     # Execute desired processes
-    _rpm2repo()
-    _reposyncer()
-    _repocreator()
+    with repolog.span('phase', 'rpm2repo') as span:
+        colo_created = _rpm2repo(args, repolog, store, scheduler, verifier)
+        span['ok'] = colo_created
+    if verifier:
+        verifier.close()
+    with repolog.span('phase', 'reposync') as span:
+        synced = _reposyncer(args, repolog, store, scheduler, prober)
+        span['ok'] = synced
+    with repolog.span('phase', 'createrepo') as span:
+        created = _repocreator(args, repolog)
+        span['ok'] = created
+
+    if args.gc:
+        packagestore(os.path.join(REPO_ROOT_DIR, REPO_STORE), repolog).gc()
+
+    repolog.close()
+    sys.exit(0 if synced and created and colo_created else 1)